@@ -0,0 +1,180 @@
+import numpy as np
+import scipy.sparse as sp
+from networkx import MultiDiGraph
+from pyformlang.finite_automaton import Symbol
+from project.graph_index import GraphIndex
+from project.task3 import (
+    AdjacencyMatrixFA,
+    cached_answer,
+    compiled_regex,
+    get_nodes_pairs,
+    graph_automaton,
+)
+
+__all__ = ["bidirectional_rpq"]
+
+
+def _neighbours(
+    indptr: np.ndarray, indices: np.ndarray, vertices: np.ndarray
+) -> tuple[np.ndarray, np.ndarray]:
+    # all stored entries of the rows `vertices`, as (position in vertices, column)
+    first = indptr[vertices]
+    counts = indptr[vertices + 1] - first
+    owners = np.repeat(np.arange(len(vertices)), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    return owners, indices[first[owners] + offsets]
+
+
+class _Search:
+    """
+    One direction of the search: the product cells visited so far as a
+    bitmap, and the moves of the automaton and of the graph per symbol.
+    """
+
+    def __init__(
+        self,
+        moves: dict[Symbol, tuple[np.ndarray, np.ndarray]],
+        edges: dict[Symbol, sp.csr_matrix],
+        shape: tuple[int, int],
+    ):
+        self.moves = moves
+        self.edges = edges
+        self.visited = np.zeros(shape, dtype=bool)
+        self.touched: list[tuple[np.ndarray, np.ndarray]] = []
+
+    def start(self, rows: np.ndarray, columns: np.ndarray):
+        self.front = (rows, columns)
+        self.mark(rows, columns)
+
+    def mark(self, rows: np.ndarray, columns: np.ndarray):
+        self.visited[rows, columns] = True
+        self.touched.append((rows, columns))
+
+    def reset(self):
+        for rows, columns in self.touched:
+            self.visited[rows, columns] = False
+        self.touched.clear()
+
+    def step(self) -> tuple[np.ndarray, np.ndarray]:
+        rows, columns = self.front
+        reached_rows, reached_columns = [], []
+        for symbol, (sources, targets) in self.moves.items():
+            graph = self.edges[symbol]
+            for source, target in zip(sources.tolist(), targets.tolist()):
+                vertices = columns[rows == source]
+                if len(vertices) == 0:
+                    continue
+                _, reached = _neighbours(graph.indptr, graph.indices, vertices)
+                reached_rows.append(np.full(len(reached), target, dtype=np.int64))
+                reached_columns.append(reached)
+
+        if not reached_rows:
+            self.front = (rows[:0], columns[:0])
+            return self.front
+
+        width = self.visited.shape[1]
+        cells = np.unique(
+            np.concatenate(reached_rows) * width + np.concatenate(reached_columns)
+        )
+        rows, columns = np.divmod(cells, width)
+        new = ~self.visited[rows, columns]
+        self.front = (rows[new], columns[new])
+        self.mark(*self.front)
+        return self.front
+
+
+def _searches(
+    dfa: AdjacencyMatrixFA, graph: AdjacencyMatrixFA
+) -> tuple[_Search, _Search]:
+    symbols = dfa.matricies.keys() & graph.matricies.keys()
+    forward_moves, backward_moves = {}, {}
+    for symbol in symbols:
+        sources, targets = (np.asarray(x) for x in dfa.matricies[symbol].nonzero())
+        forward_moves[symbol] = (sources, targets)
+        backward_moves[symbol] = (targets, sources)
+
+    # out-edges are the rows of A, in-edges the rows of Aᵀ
+    out_edges = {s: graph.matricies[s] for s in symbols}
+    in_edges = graph.in_edges()
+    in_edges = {
+        s: sp.csr_matrix(
+            (in_edges[s].data, in_edges[s].indices, in_edges[s].indptr),
+            shape=in_edges[s].shape,
+        )
+        for s in symbols
+    }
+
+    shape = (dfa.states_count, graph.states_count)
+    return (
+        _Search(forward_moves, out_edges, shape),
+        _Search(backward_moves, in_edges, shape),
+    )
+
+
+def _connected(
+    forward: _Search,
+    backward: _Search,
+    dfa_starts: np.ndarray,
+    dfa_finals: np.ndarray,
+    start: int,
+    final: int,
+) -> bool:
+    forward.start(dfa_starts, np.full(len(dfa_starts), start, dtype=np.int64))
+    backward.start(dfa_finals, np.full(len(dfa_finals), final, dtype=np.int64))
+    try:
+        if forward.visited[backward.front].any():
+            return True
+        while len(forward.front[0]) > 0 and len(backward.front[0]) > 0:
+            # advance the smaller frontier, the other one waits for it
+            search, other = (
+                (forward, backward)
+                if len(forward.front[0]) <= len(backward.front[0])
+                else (backward, forward)
+            )
+            rows, columns = search.step()
+            if other.visited[rows, columns].any():
+                return True
+        return False
+    finally:
+        forward.reset()
+        backward.reset()
+
+
+def bidirectional_rpq(
+    regex: str,
+    graph: MultiDiGraph | GraphIndex,
+    start_nodes: set[int],
+    final_nodes: set[int],
+) -> set[tuple[int, int]]:
+    """
+    RPQ answered pair by pair: a search forward over (DFA, graph) from the
+    start node and a search backward over the reversed DFA and the
+    transposed graph from the final node meet in a product state exactly
+    when the pair is in the answer. Every search stops at the first meeting,
+    so point-to-point checks touch a small part of the graph. Meant for few
+    start and final nodes; `ms_bfs_based_rpq` suits large sets.
+    """
+
+    def compute() -> set[tuple[int, int]]:
+        dfa = compiled_regex(regex, sp.csr_matrix)
+        graph_fa = graph_automaton(graph, start_nodes, final_nodes, sp.csr_matrix)
+        forward, backward = _searches(dfa, graph_fa)
+        dfa_starts = np.array(sorted(dfa.start_states), dtype=np.int64)
+        dfa_finals = np.array(sorted(dfa.final_states), dtype=np.int64)
+
+        found_starts, found_finals = [], []
+        for start in sorted(graph_fa.start_states):
+            for final in sorted(graph_fa.final_states):
+                if _connected(forward, backward, dfa_starts, dfa_finals, start, final):
+                    found_starts.append(start)
+                    found_finals.append(final)
+
+        return get_nodes_pairs(
+            graph_fa,
+            np.array(found_starts, dtype=np.int64),
+            np.array(found_finals, dtype=np.int64),
+        )
+
+    return cached_answer(
+        graph, "bidirectional", regex, start_nodes, final_nodes, compute
+    )
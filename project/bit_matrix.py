@@ -0,0 +1,279 @@
+import numpy as np
+import scipy.sparse as sp
+
+__all__ = ["BitMatrix"]
+
+WORD_BITS = 64
+WORD = np.dtype("<u8")
+
+# number of gathered words processed at once by the boolean product
+_MATMUL_CHUNK = 1 << 22
+
+_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.int64)
+
+
+def _words_count(columns: int) -> int:
+    return (columns + WORD_BITS - 1) // WORD_BITS
+
+
+def _pack(dense: np.ndarray) -> np.ndarray:
+    rows, columns = dense.shape
+    packed = np.zeros((rows, _words_count(columns) * 8), dtype=np.uint8)
+    if columns:
+        bytes_ = np.packbits(dense, axis=1, bitorder="little")
+        packed[:, : bytes_.shape[1]] = bytes_
+    return packed.view(WORD)
+
+
+def _unpack(words: np.ndarray, columns: int) -> np.ndarray:
+    bytes_ = np.ascontiguousarray(words).view(np.uint8)
+    return np.unpackbits(bytes_, axis=1, count=columns, bitorder="little").view(bool)
+
+
+class BitMatrix:
+    """
+    Boolean matrix with every row packed into 64-bit words.
+    Mimics the part of the scipy sparse interface used by AdjacencyMatrixFA,
+    so the class itself can be passed wherever a `sparse_format` is expected.
+    """
+
+    format = "bit"
+    ndim = 2
+    dtype = np.dtype(bool)
+
+    # make numpy defer `ndarray @ BitMatrix` and friends to our reflected methods
+    __array_ufunc__ = None
+
+    def __init__(self, arg1, shape=None, dtype=bool):
+        if isinstance(arg1, BitMatrix):
+            self.shape = arg1.shape
+            self.words = arg1.words.copy()
+        elif sp.issparse(arg1):
+            coo = arg1.tocoo()
+            self._init_from_coo(coo.data, coo.row, coo.col, arg1.shape)
+        elif isinstance(arg1, tuple) and len(arg1) == 2 and np.isscalar(arg1[0]):
+            self.shape = (int(arg1[0]), int(arg1[1]))
+            self.words = np.zeros((self.shape[0], _words_count(self.shape[1])), WORD)
+        elif isinstance(arg1, tuple) and len(arg1) == 2:
+            data, (rows, columns) = arg1
+            if shape is None:
+                shape = (
+                    int(np.max(rows, initial=-1)) + 1,
+                    int(np.max(columns, initial=-1)) + 1,
+                )
+            self._init_from_coo(data, rows, columns, shape)
+        else:
+            dense = np.atleast_2d(np.asarray(arg1, dtype=bool))
+            self.shape = dense.shape
+            self.words = _pack(dense)
+
+    def _init_from_coo(self, data, rows, columns, shape):
+        self.shape = (int(shape[0]), int(shape[1]))
+        self.words = np.zeros((self.shape[0], _words_count(self.shape[1])), WORD)
+
+        mask = np.asarray(data, dtype=bool)
+        rows = np.asarray(rows, dtype=np.int64)[mask]
+        columns = np.asarray(columns, dtype=np.int64)[mask]
+        bits = np.left_shift(np.uint64(1), (columns % WORD_BITS).astype(np.uint64))
+        np.bitwise_or.at(self.words, (rows, columns // WORD_BITS), bits)
+
+    @classmethod
+    def from_words(cls, words: np.ndarray, columns: int) -> "BitMatrix":
+        matrix = cls.__new__(cls)
+        matrix.shape = (words.shape[0], columns)
+        matrix.words = words
+        return matrix
+
+    @classmethod
+    def kron(cls, a, b) -> "BitMatrix":
+        a, b = cls._coerce(a), cls._coerce(b)
+        (n1, m1), (n2, m2) = a.shape, b.shape
+        words = np.zeros((n1 * n2, _words_count(m1 * m2)), WORD)
+        if b.words.shape[1] == 0:
+            return cls.from_words(words, m1 * m2)
+
+        # the block of a set bit (i, j) is b shifted right by j * m2 bits, so
+        # the rows of every column j of a get one shifted copy of b's words
+        rows, columns = a.nonzero()
+        order = np.argsort(columns, kind="stable")
+        rows, columns = rows[order], columns[order]
+        bounds = np.flatnonzero(np.diff(columns)) + 1
+        width = b.words.shape[1]
+        for group in np.split(np.arange(len(rows)), bounds):
+            if len(group) == 0:
+                continue
+            offset = int(columns[group[0]]) * m2
+            first, shift = divmod(offset, WORD_BITS)
+            targets = (rows[group][:, None] * n2 + np.arange(n2)[None, :]).ravel()
+            low = np.tile(b.words << np.uint64(shift), (len(group), 1))
+            low_columns = np.arange(first, first + width)
+            keep = low_columns < words.shape[1]
+            words[np.ix_(targets, low_columns[keep])] |= low[:, keep]
+            if shift:
+                high = np.tile(b.words >> np.uint64(WORD_BITS - shift), (len(group), 1))
+                high_columns = low_columns + 1
+                keep = high_columns < words.shape[1]
+                words[np.ix_(targets, high_columns[keep])] |= high[:, keep]
+
+        return cls.from_words(words, m1 * m2)
+
+    @classmethod
+    def _coerce(cls, other) -> "BitMatrix":
+        return other if isinstance(other, BitMatrix) else cls(other)
+
+    @property
+    def nnz(self) -> int:
+        return int(_POPCOUNT[self.words.view(np.uint8)].sum())
+
+    @property
+    def nbytes(self) -> int:
+        return self.words.nbytes
+
+    @property
+    def T(self) -> "BitMatrix":
+        return self.transpose()
+
+    def count_nonzero(self) -> int:
+        return self.nnz
+
+    def getformat(self) -> str:
+        return self.format
+
+    def copy(self) -> "BitMatrix":
+        return BitMatrix(self)
+
+    def toarray(self) -> np.ndarray:
+        return _unpack(self.words, self.shape[1])
+
+    def __array__(self, dtype=None, copy=None) -> np.ndarray:
+        return self.toarray() if dtype is None else self.toarray().astype(dtype)
+
+    def row_array(self, i: int) -> np.ndarray:
+        return _unpack(self.words[i : i + 1], self.shape[1])[0]
+
+    def nonzero(self) -> tuple[np.ndarray, np.ndarray]:
+        word_rows, word_columns = np.nonzero(self.words)
+        bits = _unpack(self.words[word_rows, word_columns][:, None], WORD_BITS)
+        hits, offsets = np.nonzero(bits)
+        return word_rows[hits], word_columns[hits] * WORD_BITS + offsets
+
+    def tocoo(self) -> sp.coo_matrix:
+        rows, columns = self.nonzero()
+        return sp.coo_matrix(
+            (np.ones(len(rows), dtype=bool), (rows, columns)), shape=self.shape
+        )
+
+    def tocsr(self) -> sp.csr_matrix:
+        return self.tocoo().tocsr()
+
+    def tocsc(self) -> sp.csc_matrix:
+        return self.tocoo().tocsc()
+
+    def getrow(self, i: int) -> sp.csr_matrix:
+        return sp.csr_matrix(self.row_array(i)[None, :])
+
+    def transpose(self) -> "BitMatrix":
+        # through the set bits only, never the whole matrix unpacked
+        rows, columns = self.nonzero()
+        matrix = BitMatrix.__new__(BitMatrix)
+        matrix._init_from_coo(
+            np.ones(len(rows), dtype=bool), columns, rows, self.shape[::-1]
+        )
+        return matrix
+
+    def __getitem__(self, key):
+        rows, columns = key if isinstance(key, tuple) else (key, slice(None))
+
+        if np.isscalar(rows) and np.isscalar(columns):
+            word = self.words[rows, columns // WORD_BITS]
+            return bool((int(word) >> (int(columns) % WORD_BITS)) & 1)
+
+        words = self.words[[rows] if np.isscalar(rows) else rows]
+        if isinstance(columns, slice) and columns == slice(None):
+            return BitMatrix.from_words(words, self.shape[1])
+
+        width = np.arange(self.shape[1])[columns].size
+        dense = _unpack(words, self.shape[1])[:, columns]
+        return BitMatrix(dense.reshape(words.shape[0], width))
+
+    def __setitem__(self, rows, value):
+        self.words[rows] = BitMatrix._coerce(value).words
+
+    def __add__(self, other) -> "BitMatrix":
+        return BitMatrix.from_words(
+            self.words | BitMatrix._coerce(other).words, self.shape[1]
+        )
+
+    __radd__ = __add__
+    __or__ = __add__
+    __ror__ = __add__
+
+    def __and__(self, other) -> "BitMatrix":
+        return BitMatrix.from_words(
+            self.words & BitMatrix._coerce(other).words, self.shape[1]
+        )
+
+    __rand__ = __and__
+
+    def __gt__(self, other) -> "BitMatrix":
+        return BitMatrix.from_words(
+            self.words & ~BitMatrix._coerce(other).words, self.shape[1]
+        )
+
+    def __lt__(self, other) -> "BitMatrix":
+        return BitMatrix._coerce(other) > self
+
+    @staticmethod
+    def _product(rows, columns, rows_count: int, other: "BitMatrix") -> "BitMatrix":
+        # row i of the product is the OR of other's rows at columns[rows == i]
+        words = np.zeros((rows_count, other.words.shape[1]), WORD)
+        if len(rows) == 0 or other.words.shape[1] == 0:
+            return BitMatrix.from_words(words, other.shape[1])
+
+        # rows come sorted, so every chunk is a run of whole rows
+        chunk = max(1, _MATMUL_CHUNK // other.words.shape[1])
+        boundaries = np.flatnonzero(np.diff(rows)) + 1
+        starts = np.concatenate(([0], boundaries))
+        ends = np.concatenate((boundaries, [len(rows)]))
+
+        lo = 0
+        while lo < len(starts):
+            hi = max(lo + 1, np.searchsorted(ends, starts[lo] + chunk, side="right"))
+            segment = slice(starts[lo], ends[hi - 1])
+            gathered = other.words[columns[segment]]
+            words[rows[starts[lo:hi]]] = np.bitwise_or.reduceat(
+                gathered, starts[lo:hi] - starts[lo], axis=0
+            )
+            lo = hi
+
+        return BitMatrix.from_words(words, other.shape[1])
+
+    def __matmul__(self, other):
+        if isinstance(other, np.ndarray) and other.ndim == 1:
+            vector = _pack(other.astype(bool)[None, :])[0]
+            return (self.words & vector).any(axis=1)
+
+        rows, columns = self.nonzero()
+        return BitMatrix._product(
+            rows, columns, self.shape[0], BitMatrix._coerce(other)
+        )
+
+    def __rmatmul__(self, other):
+        if isinstance(other, np.ndarray) and other.ndim == 1:
+            mask = other.astype(bool)
+            row = np.bitwise_or.reduce(self.words[mask], axis=0)
+            return _unpack(row[None, :], self.shape[1])[0]
+
+        if sp.issparse(other):
+            coo = other.tocsr().tocoo()
+            mask = coo.data != 0
+            return BitMatrix._product(
+                coo.row[mask], coo.col[mask], other.shape[0], self
+            )
+
+        return BitMatrix._coerce(other) @ self
+
+    def __repr__(self) -> str:
+        return (
+            f"<{self.shape[0]}x{self.shape[1]} BitMatrix with {self.nnz} stored bits>"
+        )
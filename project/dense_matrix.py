@@ -0,0 +1,147 @@
+import numpy as np
+import scipy.sparse as sp
+
+__all__ = ["DenseMatrix"]
+
+
+class DenseMatrix:
+    """
+    Boolean matrix kept as a plain NumPy bool array.
+    Exposes the same scipy-like surface as BitMatrix, so it can be used as a
+    `sparse_format` too. Products go through float32 BLAS and are thresholded.
+    """
+
+    format = "dense"
+    ndim = 2
+    dtype = np.dtype(bool)
+
+    __array_ufunc__ = None
+
+    def __init__(self, arg1, shape=None, dtype=bool):
+        if isinstance(arg1, DenseMatrix):
+            self.array = arg1.array.copy()
+        elif sp.issparse(arg1):
+            self.array = arg1.toarray().astype(bool)
+        elif isinstance(arg1, tuple) and len(arg1) == 2 and np.isscalar(arg1[0]):
+            self.array = np.zeros((int(arg1[0]), int(arg1[1])), dtype=bool)
+        elif isinstance(arg1, tuple) and len(arg1) == 2:
+            self.array = sp.coo_matrix(arg1, shape, dtype=bool).toarray()
+        else:
+            self.array = np.atleast_2d(np.asarray(arg1, dtype=bool))
+
+    @classmethod
+    def from_array(cls, array: np.ndarray) -> "DenseMatrix":
+        matrix = cls.__new__(cls)
+        matrix.array = array
+        return matrix
+
+    @classmethod
+    def kron(cls, a, b) -> "DenseMatrix":
+        return cls.from_array(np.kron(cls._coerce(a).array, cls._coerce(b).array))
+
+    @classmethod
+    def _coerce(cls, other) -> "DenseMatrix":
+        return other if isinstance(other, DenseMatrix) else cls(other)
+
+    @property
+    def shape(self) -> tuple[int, int]:
+        return self.array.shape
+
+    @property
+    def nnz(self) -> int:
+        return int(np.count_nonzero(self.array))
+
+    @property
+    def nbytes(self) -> int:
+        return self.array.nbytes
+
+    @property
+    def T(self) -> "DenseMatrix":
+        return self.transpose()
+
+    def count_nonzero(self) -> int:
+        return self.nnz
+
+    def getformat(self) -> str:
+        return self.format
+
+    def copy(self) -> "DenseMatrix":
+        return DenseMatrix(self)
+
+    def toarray(self) -> np.ndarray:
+        return self.array
+
+    def __array__(self, dtype=None, copy=None) -> np.ndarray:
+        return self.array if dtype is None else self.array.astype(dtype)
+
+    def nonzero(self) -> tuple[np.ndarray, np.ndarray]:
+        return np.nonzero(self.array)
+
+    def tocoo(self) -> sp.coo_matrix:
+        return sp.coo_matrix(self.array)
+
+    def tocsr(self) -> sp.csr_matrix:
+        return sp.csr_matrix(self.array)
+
+    def tocsc(self) -> sp.csc_matrix:
+        return sp.csc_matrix(self.array)
+
+    def getrow(self, i: int) -> sp.csr_matrix:
+        return sp.csr_matrix(self.array[i : i + 1])
+
+    def transpose(self) -> "DenseMatrix":
+        return DenseMatrix.from_array(np.ascontiguousarray(self.array.T))
+
+    def __getitem__(self, key):
+        rows, columns = key if isinstance(key, tuple) else (key, slice(None))
+
+        if np.isscalar(rows) and np.isscalar(columns):
+            return bool(self.array[rows, columns])
+
+        array = self.array[[rows] if np.isscalar(rows) else rows]
+        width = np.arange(self.shape[1])[columns].size
+        return DenseMatrix.from_array(array[:, columns].reshape(array.shape[0], width))
+
+    def __setitem__(self, rows, value):
+        self.array[rows] = DenseMatrix._coerce(value).array
+
+    def __add__(self, other) -> "DenseMatrix":
+        return DenseMatrix.from_array(self.array | DenseMatrix._coerce(other).array)
+
+    __radd__ = __add__
+    __or__ = __add__
+    __ror__ = __add__
+
+    def __and__(self, other) -> "DenseMatrix":
+        return DenseMatrix.from_array(self.array & DenseMatrix._coerce(other).array)
+
+    __rand__ = __and__
+
+    def __gt__(self, other) -> "DenseMatrix":
+        return DenseMatrix.from_array(self.array & ~DenseMatrix._coerce(other).array)
+
+    def __lt__(self, other) -> "DenseMatrix":
+        return DenseMatrix._coerce(other) > self
+
+    def __matmul__(self, other):
+        if isinstance(other, np.ndarray) and other.ndim == 1:
+            return self.array[:, other.astype(bool)].any(axis=1)
+
+        other = DenseMatrix._coerce(other)
+        product = self.array.astype(np.float32) @ other.array.astype(np.float32)
+        return DenseMatrix.from_array(product > 0)
+
+    def __rmatmul__(self, other):
+        if isinstance(other, np.ndarray) and other.ndim == 1:
+            return self.array[other.astype(bool)].any(axis=0)
+
+        if sp.issparse(other):
+            product = other.astype(np.float32) @ self.array.astype(np.float32)
+            return DenseMatrix.from_array(np.asarray(product) > 0)
+
+        return DenseMatrix._coerce(other) @ self
+
+    def __repr__(self) -> str:
+        return (
+            f"<{self.shape[0]}x{self.shape[1]} DenseMatrix with {self.nnz} true cells>"
+        )
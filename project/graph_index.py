@@ -0,0 +1,192 @@
+from collections.abc import Hashable, Iterable, Mapping
+import networkx as nx
+import numpy as np
+import scipy.sparse as sp
+from pyformlang.finite_automaton import State, Symbol
+from project.interning import EncodedGraph, Interner, encode_graph
+from project.query_cache import QueryCache
+
+__all__ = ["GraphIndex", "NodeStates", "NodeStatesByIdx", "encoded_graph"]
+
+# labels that `NondeterministicFiniteAutomaton.from_networkx` reads as epsilon
+_EPSILON_LABELS = ("epsilon", "ɛ")
+
+
+def _pad(matrix: sp.csr_matrix, n: int) -> sp.csr_matrix:
+    # empty rows and columns up to n, sharing the stored arrays
+    indptr = np.concatenate(
+        (matrix.indptr, np.full(n - matrix.shape[0], matrix.indptr[-1]))
+    )
+    return sp.csr_matrix((matrix.data, matrix.indices, indptr), shape=(n, n))
+
+
+def _epsilon_closure(matrix: sp.csr_matrix) -> sp.csr_matrix:
+    n = matrix.shape[0]
+    closure = sp.csr_matrix(matrix + sp.identity(n, dtype=bool, format="csr"))
+    while True:
+        squared = sp.csr_matrix(closure @ closure, dtype=bool)
+        if squared.nnz == closure.nnz:
+            return closure
+        closure = squared
+
+
+class NodeStates(Mapping):
+    """
+    State -> index map over interned nodes. States are the nodes wrapped in
+    `State` and are only created when iterated, not one per node up front.
+    """
+
+    def __init__(self, nodes: Interner):
+        self.nodes = nodes
+
+    def __getitem__(self, state: State) -> int:
+        return self.nodes[state.value if isinstance(state, State) else state]
+
+    def lookup(self, values: Iterable[Hashable]) -> np.ndarray:
+        return self.nodes.lookup_many(values)
+
+    def __iter__(self):
+        return (State(node) for node in self.nodes.values)
+
+    def __len__(self) -> int:
+        return len(self.nodes)
+
+
+class NodeStatesByIdx(Mapping):
+    def __init__(self, nodes: Interner):
+        self.nodes = nodes
+
+    def __getitem__(self, idx: int) -> State:
+        return State(self.nodes.values[idx])
+
+    def __iter__(self):
+        return iter(range(len(self.nodes)))
+
+    def __len__(self) -> int:
+        return len(self.nodes)
+
+
+class GraphIndex:
+    """
+    A graph prepared once for many queries.
+    Nodes and labels are interned, every label has a boolean CSR matrix and
+    its transpose, and degree statistics are kept. Engines accept it in place
+    of the `MultiDiGraph`; start and final nodes remain per-query arguments.
+    Epsilon edges are folded into the label matrices as `graph_to_nfa` does.
+    `results` keeps the answers of regular queries asked on the index.
+    """
+
+    def __init__(self, graph: nx.MultiDiGraph):
+        self._build(encode_graph(graph))
+
+    @classmethod
+    def from_encoded(cls, encoded: EncodedGraph) -> "GraphIndex":
+        """Index over already interned edges, without a networkx graph."""
+        index = cls.__new__(cls)
+        index._build(encoded)
+        return index
+
+    def _build(self, encoded: EncodedGraph):
+        self.encoded = encoded
+        self.nodes = self.encoded.nodes
+        self.labels = self.encoded.labels
+        self.states = NodeStates(self.nodes)
+        self.idx_by_state = NodeStatesByIdx(self.nodes)
+        self.results = QueryCache(max_bytes=16 << 20)
+        n = len(self.nodes)
+
+        labelled = np.array(
+            [label is not None for label in self.labels.values], dtype=bool
+        )
+        labelled = labelled[self.encoded.label_ids]
+        sources = self.encoded.sources[labelled]
+        targets = self.encoded.targets[labelled]
+        label_ids = self.encoded.label_ids[labelled]
+
+        self.out_degree = np.bincount(sources, minlength=n)
+        self.in_degree = np.bincount(targets, minlength=n)
+        counts = np.bincount(label_ids, minlength=len(self.labels))
+
+        matricies = {}
+        for label_id, label in enumerate(self.labels.values):
+            if counts[label_id] == 0:
+                continue
+            edges = label_ids == label_id
+            matricies[label] = sp.csr_matrix(
+                (
+                    np.ones(counts[label_id], dtype=bool),
+                    (sources[edges], targets[edges]),
+                ),
+                shape=(n, n),
+                dtype=bool,
+            )
+
+        self.edge_counts: dict[Hashable, int] = {
+            label: int(counts[self.labels[label]]) for label in matricies
+        }
+
+        epsilon = [
+            matricies.pop(label) for label in _EPSILON_LABELS if label in matricies
+        ]
+        if epsilon:
+            closure = _epsilon_closure(sum(epsilon[1:], epsilon[0]))
+            matricies = {
+                label: sp.csr_matrix(closure @ matrix, dtype=bool)
+                for label, matrix in matricies.items()
+            }
+
+        self.matricies: dict[Symbol, sp.csr_matrix] = {
+            Symbol(label): matrix for label, matrix in matricies.items()
+        }
+        self.transposed: dict[Symbol, sp.csr_matrix] = {
+            symbol: matrix.transpose().tocsr()
+            for symbol, matrix in self.matricies.items()
+        }
+
+    @property
+    def states_count(self) -> int:
+        return len(self.states)
+
+    def with_isolated(self, nodes: Iterable[Hashable]) -> "GraphIndex":
+        """
+        Index with the `nodes` missing from the graph added as isolated
+        nodes, as `graph_to_nfa` adds unknown start and final nodes.
+        The index itself when all of them are known.
+        """
+        missing = [node for node in dict.fromkeys(nodes) if node not in self.nodes]
+        if not missing:
+            return self
+
+        index = GraphIndex.__new__(GraphIndex)
+        index.nodes = self.nodes.copy()
+        index.nodes.intern_many(missing)
+        n = len(index.nodes)
+        index.labels = self.labels
+        index.encoded = EncodedGraph(
+            index.nodes,
+            self.labels,
+            self.encoded.sources,
+            self.encoded.label_ids,
+            self.encoded.targets,
+        )
+        index.states = NodeStates(index.nodes)
+        index.idx_by_state = NodeStatesByIdx(index.nodes)
+        index.results = QueryCache(max_bytes=16 << 20)
+        index.out_degree = np.pad(self.out_degree, (0, len(missing)))
+        index.in_degree = np.pad(self.in_degree, (0, len(missing)))
+        index.edge_counts = self.edge_counts
+        index.matricies = {s: _pad(m, n) for s, m in self.matricies.items()}
+        index.transposed = {s: _pad(m, n) for s, m in self.transposed.items()}
+        return index
+
+    def nodes_idx(self, nodes: set[Hashable] | None) -> np.ndarray:
+        """Indices of `nodes`, all nodes when the set is empty or None."""
+        if not nodes:
+            return np.arange(len(self.nodes), dtype=np.int64)
+        return self.nodes.lookup_many(nodes)
+
+
+def encoded_graph(graph: nx.DiGraph | GraphIndex) -> EncodedGraph:
+    if isinstance(graph, GraphIndex):
+        return graph.encoded
+    return encode_graph(graph)
@@ -0,0 +1,83 @@
+from collections.abc import Hashable, Iterable, Mapping
+from dataclasses import dataclass
+import networkx as nx
+import numpy as np
+
+__all__ = ["Interner", "EncodedGraph", "encode_graph"]
+
+
+class Interner(Mapping):
+    """
+    Numbers hashable values densely, in first-seen order.
+    `interner[value]` is the id of a known value, `interner.values[i]` is the
+    value with id `i`, so engines can work on ints and convert back at the end.
+    """
+
+    def __init__(self, values: Iterable[Hashable] = ()):
+        self.values: list[Hashable] = []
+        self.ids: dict[Hashable, int] = {}
+        for value in values:
+            self.intern(value)
+
+    def intern(self, value: Hashable) -> int:
+        idx = self.ids.get(value)
+        if idx is None:
+            idx = self.ids[value] = len(self.values)
+            self.values.append(value)
+        return idx
+
+    def copy(self) -> "Interner":
+        interner = Interner()
+        interner.values = list(self.values)
+        interner.ids = dict(self.ids)
+        return interner
+
+    def intern_many(self, values: Iterable[Hashable]) -> np.ndarray:
+        return np.fromiter((self.intern(value) for value in values), dtype=np.int64)
+
+    def lookup_many(self, values: Iterable[Hashable]) -> np.ndarray:
+        return np.fromiter((self.ids[value] for value in values), dtype=np.int64)
+
+    def decode(self, ids: Iterable[int]) -> list[Hashable]:
+        values = self.values
+        return [values[i] for i in np.asarray(ids, dtype=np.int64).tolist()]
+
+    def mask(self, values: Iterable[Hashable]) -> np.ndarray:
+        """Bool vector over ids, set for the known values among `values`."""
+        mask = np.zeros(len(self.values), dtype=bool)
+        mask[[self.ids[value] for value in values if value in self.ids]] = True
+        return mask
+
+    def __getitem__(self, value: Hashable) -> int:
+        return self.ids[value]
+
+    def __contains__(self, value: object) -> bool:
+        return value in self.ids
+
+    def __iter__(self):
+        return iter(self.values)
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+
+@dataclass
+class EncodedGraph:
+    nodes: Interner
+    labels: Interner
+    sources: np.ndarray
+    label_ids: np.ndarray
+    targets: np.ndarray
+
+
+def encode_graph(graph: nx.DiGraph) -> EncodedGraph:
+    nodes = Interner(graph.nodes)
+    labels = Interner()
+    edges = list(graph.edges.data("label"))
+    return EncodedGraph(
+        nodes,
+        labels,
+        nodes.lookup_many(v1 for v1, _, _ in edges),
+        labels.intern_many(label for _, _, label in edges),
+        nodes.lookup_many(v2 for _, v2, _ in edges),
+    )
@@ -0,0 +1,100 @@
+from collections import Counter
+from dataclasses import dataclass
+import numpy as np
+import scipy.sparse as sp
+from project.bit_matrix import BitMatrix
+from project.dense_matrix import DenseMatrix
+
+__all__ = ["FormatDecision", "FormatSelector", "resolve_format", "refit_by_sp_format"]
+
+
+@dataclass
+class FormatDecision:
+    role: str
+    shape: tuple[int, int]
+    nnz: int
+    format: str
+
+
+_SCIPY_FORMATS = {sp.csr_matrix: "csr", sp.csc_matrix: "csc"}
+
+
+def _format_name(sparse_format) -> str:
+    return _SCIPY_FORMATS.get(sparse_format) or sparse_format.format
+
+
+def _convert(matrix, sparse_format):
+    if isinstance(matrix, sparse_format):
+        return matrix
+    if sparse_format is sp.csr_matrix:
+        return sp.csr_matrix(matrix.tocsr())
+    if sparse_format is sp.csc_matrix:
+        return sp.csc_matrix(matrix.tocsc())
+    return sparse_format(matrix)
+
+
+class FormatSelector:
+    """
+    `sparse_format` that picks a representation for every matrix it builds
+    from the matrix shape and the number of stored pairs:
+    small matrices stay dense, matrices denser than `bit_density` are
+    bit-packed and everything else is CSR (CSC for tall matrices).
+    Every decision is appended to `decisions`.
+    """
+
+    def __init__(self, dense_cells: int = 1 << 16, bit_density: float = 1 / 32):
+        self.dense_cells = dense_cells
+        self.bit_density = bit_density
+        self.decisions: list[FormatDecision] = []
+
+    def choose(self, shape: tuple[int, int], nnz: int):
+        cells = shape[0] * shape[1]
+        if cells <= self.dense_cells:
+            return DenseMatrix
+        if nnz >= cells * self.bit_density:
+            return BitMatrix
+        return sp.csc_matrix if shape[0] > shape[1] else sp.csr_matrix
+
+    def fit(self, matrix, role: str = "refit"):
+        if isinstance(matrix, np.ndarray):
+            # scipy answers some mixed operations with a dense np.matrix
+            matrix = DenseMatrix(np.asarray(matrix))
+        sparse_format = self.choose(matrix.shape, matrix.nnz)
+        self.decisions.append(
+            FormatDecision(role, matrix.shape, matrix.nnz, _format_name(sparse_format))
+        )
+        return _convert(matrix, sparse_format)
+
+    def counts(self) -> Counter:
+        return Counter(decision.format for decision in self.decisions)
+
+    def kron(self, a, b):
+        shape = (a.shape[0] * b.shape[0], a.shape[1] * b.shape[1])
+        sparse_format = self.choose(shape, a.nnz * b.nnz)
+        self.decisions.append(
+            FormatDecision("kron", shape, a.nnz * b.nnz, _format_name(sparse_format))
+        )
+        if hasattr(sparse_format, "kron"):
+            return sparse_format.kron(a, b)
+        return sp.kron(
+            sp.csr_matrix(a.tocsr()),
+            sp.csr_matrix(b.tocsr()),
+            format=_format_name(sparse_format),
+        )
+
+    def __call__(self, arg1, shape=None, dtype=bool):
+        if sp.issparse(arg1) or hasattr(arg1, "tocsr"):
+            matrix = sp.csr_matrix(arg1.tocsr(), dtype=bool)
+        else:
+            matrix = sp.csr_matrix(arg1, shape, dtype=bool)
+        return self.fit(matrix, "build")
+
+
+def resolve_format(sparse_format):
+    return FormatSelector() if sparse_format == "auto" else sparse_format
+
+
+def refit_by_sp_format(matrix, sparse_format, role: str):
+    if isinstance(sparse_format, FormatSelector):
+        return sparse_format.fit(matrix, role)
+    return matrix
@@ -0,0 +1,146 @@
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Type
+import numpy as np
+import scipy.sparse as sp
+from networkx import MultiDiGraph
+from project.task3 import (
+    AdjacencyMatrixFA,
+    cached_answer,
+    compiled_regex,
+    graph_automaton,
+)
+from project.graph_index import GraphIndex
+from project.task4 import iter_ms_bfs_pairs
+
+__all__ = ["chunk_size_for_budget", "parallel_ms_bfs_rpq"]
+
+# bytes per cell of a chunk's front: the visited bitmap plus the dense front
+# and the reached block of a pull level
+_BYTES_PER_CELL = 3
+# bytes per (start, vertex) pair for the set of reported pairs: a bitmap byte,
+# or as much again while its sorted runs are merged
+_BYTES_PER_PAIR = 2
+
+# state of a worker process, set once by `_init_worker`
+_worker = {}
+
+
+def chunk_size_for_budget(
+    memory_budget: int, dfa_states_count: int, graph_states_count: int, workers: int
+) -> int:
+    """Number of start nodes whose fronts fit into a worker's share of the budget."""
+    per_start = graph_states_count * (
+        dfa_states_count * _BYTES_PER_CELL + _BYTES_PER_PAIR
+    )
+    return max(1, memory_budget // max(workers, 1) // max(per_start, 1))
+
+
+def _init_worker(
+    path: str,
+    regex: str,
+    finals: np.ndarray,
+    sparse_format: Type[sp.spmatrix],
+    pull_ratio: float,
+):
+    # csr matrices over the memory-mapped files: every worker reads the same pages
+    graph = AdjacencyMatrixFA.load(path, mmap=True, sparse_format=sp.csr_matrix)
+    _worker["graph"] = graph
+    _worker["dfa"] = compiled_regex(regex, sparse_format)
+    _worker["final_mask"] = graph.states_vector(finals)
+    _worker["sparse_format"] = sparse_format
+    _worker["pull_ratio"] = pull_ratio
+
+
+def _run_chunk(starts: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    blocks, columns = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)]
+    pairs = iter_ms_bfs_pairs(
+        _worker["dfa"],
+        _worker["graph"],
+        starts,
+        _worker["final_mask"],
+        _worker["sparse_format"],
+        _worker["pull_ratio"],
+    )
+    for block, column in pairs:
+        blocks.append(block)
+        columns.append(column)
+    return starts[np.concatenate(blocks)], np.concatenate(columns)
+
+
+def parallel_ms_bfs_rpq(
+    regex: str,
+    graph: MultiDiGraph | GraphIndex,
+    start_nodes: set[int],
+    final_nodes: set[int],
+    memory_budget: int = 1 << 30,
+    max_workers: int = None,
+    sparse_format: Type[sp.spmatrix] = sp.csr_matrix,
+    pull_ratio: float = 1 / 14,
+) -> set[tuple[int, int]]:
+    """
+    `ms_bfs_based_rpq` with the start nodes split into chunks whose fronts
+    fit `memory_budget` bytes in total, run in a process pool. The graph is
+    written once with `AdjacencyMatrixFA.save` and memory-mapped by workers.
+    """
+    return cached_answer(
+        graph,
+        "parallel ms-bfs",
+        regex,
+        start_nodes,
+        final_nodes,
+        lambda: _parallel_ms_bfs_rpq(
+            regex,
+            graph,
+            start_nodes,
+            final_nodes,
+            memory_budget,
+            max_workers,
+            sparse_format,
+            pull_ratio,
+        ),
+    )
+
+
+def _parallel_ms_bfs_rpq(
+    regex: str,
+    graph: MultiDiGraph | GraphIndex,
+    start_nodes: set[int],
+    final_nodes: set[int],
+    memory_budget: int,
+    max_workers: int,
+    sparse_format: Type[sp.spmatrix],
+    pull_ratio: float,
+) -> set[tuple[int, int]]:
+    graph_fa = graph_automaton(graph, start_nodes, final_nodes, sp.csr_matrix)
+    # empty sets mean all nodes, as in the sequential engine
+    starts = np.fromiter(graph_fa.start_states, dtype=np.int64)
+    finals = np.fromiter(graph_fa.final_states, dtype=np.int64)
+    if len(starts) == 0 or len(finals) == 0:
+        return set()
+
+    workers = max_workers or os.cpu_count() or 1
+    dfa_states_count = compiled_regex(regex, sp.csr_matrix).states_count
+    chunk = chunk_size_for_budget(
+        memory_budget, dfa_states_count, graph_fa.states_count, workers
+    )
+    chunks = [starts[i : i + chunk] for i in range(0, len(starts), chunk)]
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = Path(directory) / "graph"
+        graph_fa.save(path)
+        with ProcessPoolExecutor(
+            max_workers=min(workers, len(chunks)),
+            initializer=_init_worker,
+            initargs=(str(path), regex, finals, sparse_format, pull_ratio),
+        ) as executor:
+            results = list(executor.map(_run_chunk, chunks))
+
+    node_by_idx = graph_fa.idx_by_state
+    return {
+        (node_by_idx[i].value, node_by_idx[j].value)
+        for found_starts, found_finals in results
+        for i, j in zip(found_starts.tolist(), found_finals.tolist())
+    }
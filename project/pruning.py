@@ -0,0 +1,165 @@
+import itertools
+from collections.abc import Callable, Hashable
+from dataclasses import dataclass
+import networkx as nx
+import numpy as np
+import scipy.sparse as sp
+from scipy.sparse.csgraph import breadth_first_order
+from project.graph_index import _EPSILON_LABELS, GraphIndex
+from project.interning import EncodedGraph, Interner, encode_graph
+from project.task3 import AdjacencyMatrixFA, compiled_regex
+from project.task4 import ms_bfs_based_rpq
+
+__all__ = ["PrunedGraph", "required_labels", "prune_graph", "pruned_rpq"]
+
+
+@dataclass
+class PrunedGraph:
+    """
+    Induced subgraph on the nodes that are reachable from the start nodes and
+    co-reachable to the final nodes, numbered densely.
+    `nodes[i]` is the original id of node `i` of `graph`.
+    """
+
+    graph: GraphIndex
+    nodes: list[Hashable]
+    start_nodes: set[int]
+    final_nodes: set[int]
+
+
+def required_labels(dfa: AdjacencyMatrixFA) -> set[Hashable]:
+    """Labels that every word accepted by `dfa` contains."""
+    final = dfa.states_vector(dfa.final_states)
+
+    def accepts_without(symbol) -> bool:
+        front = dfa.states_vector(dfa.start_states)
+        visited = front.copy()
+        while front.any():
+            if (front & final).any():
+                return True
+            reached = np.zeros_like(front)
+            for other in dfa.matricies:
+                if other != symbol:
+                    reached |= dfa.advance(front, other)
+            front = reached & ~visited
+            visited |= front
+        return False
+
+    if not accepts_without(None):
+        # an empty language: no label can help
+        return set()
+    return {symbol.value for symbol in dfa.matricies if not accepts_without(symbol)}
+
+
+def _reachable(adjacency: sp.csr_matrix, sources: np.ndarray) -> np.ndarray:
+    # one BFS from a virtual node linked to every source
+    n = adjacency.shape[0]
+    links = sp.csr_matrix(
+        (np.ones(len(sources), dtype=bool), (np.full(len(sources), n), sources)),
+        shape=(n + 1, n + 1),
+    )
+    graph = sp.block_diag((adjacency, sp.csr_matrix((1, 1), dtype=bool))) + links
+    order = breadth_first_order(
+        graph.tocsr(), n, directed=True, return_predecessors=False
+    )
+    mask = np.zeros(n + 1, dtype=bool)
+    mask[order] = True
+    return mask[:n]
+
+
+def _nodes_mask(encoded: EncodedGraph, nodes: set[Hashable]) -> np.ndarray:
+    if not nodes:
+        return np.ones(len(encoded.nodes), dtype=bool)
+    return encoded.nodes.mask(nodes)
+
+
+def prune_graph(
+    regex: str,
+    graph: nx.MultiDiGraph | GraphIndex,
+    start_nodes: set[int],
+    final_nodes: set[int],
+) -> PrunedGraph | None:
+    """
+    `PrunedGraph` of the part of `graph` a query can use: only edges whose
+    labels occur in the minimal DFA of `regex` are followed, in one BFS from
+    the start nodes and one over reversed edges from the final nodes.
+    None when the answer is empty for sure: the regex needs a label the graph
+    does not have, or no node survives.
+    Empty or None start and final sets mean all nodes and start or final
+    nodes missing from the graph are isolated nodes, as in `graph_to_nfa`.
+    """
+    dfa = compiled_regex(regex, sp.csr_matrix)
+    query_nodes = itertools.chain(start_nodes or (), final_nodes or ())
+    if isinstance(graph, GraphIndex):
+        encoded = graph.with_isolated(query_nodes).encoded
+    else:
+        encoded = encode_graph(graph)
+        encoded.nodes.intern_many(query_nodes)
+    graph_labels = set(encoded.labels.values)
+    if not required_labels(dfa) <= graph_labels or not dfa.start_states:
+        return None
+
+    usable = {symbol.value for symbol in dfa.matricies}.union(_EPSILON_LABELS)
+    label_mask = np.array(
+        [label in usable for label in encoded.labels.values], dtype=bool
+    )
+    edges = label_mask[encoded.label_ids]
+    sources, targets = encoded.sources[edges], encoded.targets[edges]
+    n = len(encoded.nodes)
+    adjacency = sp.csr_matrix(
+        (np.ones(len(sources), dtype=bool), (sources, targets)), shape=(n, n)
+    )
+
+    starts_mask = _nodes_mask(encoded, start_nodes)
+    finals_mask = _nodes_mask(encoded, final_nodes)
+    kept = _reachable(adjacency, np.flatnonzero(starts_mask)) & _reachable(
+        adjacency.T.tocsr(), np.flatnonzero(finals_mask)
+    )
+    if not kept.any():
+        return None
+
+    new_ids = np.cumsum(kept) - 1
+    inner = kept[sources] & kept[targets]
+    pruned = GraphIndex.from_encoded(
+        EncodedGraph(
+            Interner(range(int(kept.sum()))),
+            encoded.labels,
+            new_ids[sources[inner]],
+            encoded.label_ids[edges][inner],
+            new_ids[targets[inner]],
+        )
+    )
+
+    # an empty set would mean all nodes again, so the sets are kept only
+    # when the query gave them; both have survivors since `kept` is not empty
+    pruned_starts = set(new_ids[starts_mask & kept].tolist()) if start_nodes else set()
+    pruned_finals = set(new_ids[finals_mask & kept].tolist()) if final_nodes else set()
+    return PrunedGraph(
+        pruned,
+        encoded.nodes.decode(np.flatnonzero(kept)),
+        pruned_starts,
+        pruned_finals,
+    )
+
+
+def pruned_rpq(
+    regex: str,
+    graph: nx.MultiDiGraph | GraphIndex,
+    start_nodes: set[int],
+    final_nodes: set[int],
+    engine: Callable[..., set[tuple[int, int]]] = ms_bfs_based_rpq,
+    **engine_kwargs,
+) -> set[tuple[int, int]]:
+    """
+    `engine` run on the `PrunedGraph` of the query, with the answer mapped
+    back to the original node ids.
+    """
+    pruned = prune_graph(regex, graph, start_nodes, final_nodes)
+    if pruned is None:
+        return set()
+
+    answer = engine(
+        regex, pruned.graph, pruned.start_nodes, pruned.final_nodes, **engine_kwargs
+    )
+    nodes = pruned.nodes
+    return {(nodes[v1], nodes[v2]) for v1, v2 in answer}
@@ -0,0 +1,96 @@
+import re
+from collections import OrderedDict
+from collections.abc import Callable, Hashable
+from typing import Any
+from pyformlang.cfg import CFG
+
+__all__ = [
+    "QueryCache",
+    "query_cache",
+    "canonical_regex",
+    "canonical_cfg",
+    "cfg_nbytes",
+    "matrix_nbytes",
+]
+
+
+def canonical_regex(regex: str) -> str:
+    """
+    Regex text with runs of spaces collapsed, so spacing does not matter.
+    Other whitespace is kept: pyformlang splits symbols on spaces only.
+    """
+    return re.sub(r" +", " ", regex).strip(" ")
+
+
+def canonical_cfg(cfg: CFG) -> Hashable:
+    """Start symbol and the set of productions, independent of their order."""
+    return (
+        repr(cfg.start_symbol),
+        frozenset(
+            (repr(production.head), tuple(repr(obj) for obj in production.body))
+            for production in cfg.productions
+        ),
+    )
+
+
+def cfg_nbytes(cfg: CFG) -> int:
+    # a rough size of a symbol object in a production
+    return 64 * sum(1 + len(production.body) for production in cfg.productions)
+
+
+def matrix_nbytes(matrix: Any) -> int:
+    if hasattr(matrix, "nbytes"):
+        return int(matrix.nbytes)
+    if hasattr(matrix, "indptr"):
+        return matrix.data.nbytes + matrix.indices.nbytes + matrix.indptr.nbytes
+    # dok, lil and the like: a key and a value per stored pair
+    return int(matrix.nnz) * 24
+
+
+class QueryCache:
+    """
+    Bounded LRU of compiled queries, keyed by a kind and canonical query text.
+    Every entry carries its size in bytes; the least recently used entries are
+    evicted once the total exceeds `max_bytes`. Cached values are shared
+    between callers and must be treated as read-only.
+    """
+
+    def __init__(self, max_bytes: int = 64 << 20):
+        self.max_bytes = max_bytes
+        self.entries: OrderedDict[Hashable, tuple[Any, int]] = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(
+        self, key: Hashable, compile: Callable[[], Any], sizeof: Callable[[Any], int]
+    ) -> Any:
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return entry[0]
+
+        self.misses += 1
+        value = compile()
+        size = sizeof(value)
+        if size <= self.max_bytes:
+            self.entries[key] = (value, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                _, (_, evicted) = self.entries.popitem(last=False)
+                self.size -= evicted
+                self.evictions += 1
+        return value
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+
+# shared by all engines in `project`
+query_cache = QueryCache()
@@ -0,0 +1,572 @@
+import re
+from collections.abc import Iterable
+from dataclasses import dataclass
+import numpy as np
+import scipy.sparse as sp
+from pyformlang.finite_automaton import Symbol
+from pyformlang.regular_expression.regex_objects import MisformedRegexError
+from project.interning import Interner
+
+__all__ = [
+    "RegexDFA",
+    "RegexNFA",
+    "tokenize_regex",
+    "compile_regex",
+    "compile_regex_nfa",
+]
+
+# the syntax of pyformlang `Regex`
+_CONCATENATION = (".",)
+_UNION = ("|", "+")
+_STAR = ("*",)
+_EPSILON = ("epsilon", "$")
+# single characters that always stand alone, unless escaped with "\"
+_SPECIAL_CHARACTERS = set(".|+*$()")
+
+
+def tokenize_regex(regex: str) -> list[str]:
+    """Components of `regex`, split exactly as pyformlang splits them."""
+    regex = regex.strip(" ")
+    if regex.endswith("\\") and not regex.endswith("\\\\"):
+        regex += " "
+    regex = re.sub(r" +", " ", regex)
+    regex = re.sub(r"\\ ", "\\  ", regex)
+    if regex.endswith("  "):
+        regex = regex[:-1]
+
+    # special characters get spaces around them
+    spaced = []
+    previous_is_escape = False
+    for pos, char in enumerate(regex):
+        special = not previous_is_escape and char in _SPECIAL_CHARACTERS
+        if special and pos != 0 and spaced[-1] != " ":
+            spaced.append(" ")
+        spaced.append(char)
+        if special and pos != len(regex) - 1 and regex[pos + 1] != " ":
+            spaced.append(" ")
+        previous_is_escape = char == "\\"
+
+    tokens = "".join(spaced).split(" ")
+    for i, token in enumerate(tokens):
+        # an escaped space
+        if token.endswith("\\") and not token.endswith("\\\\"):
+            tokens[i] += " "
+    return [token for token in tokens if token]
+
+
+# kinds of terms; EMPTY and EPSILON are the terms 0 and 1
+_EMPTY, _EPS, _SYMBOL, _CAT, _ALT, _STAR_KIND = range(6)
+
+
+class _Terms:
+    """
+    Hash-consed regex terms, numbered densely. Constructors normalize
+    concatenation to the right, unions to flat sets and drop trivial terms,
+    so the derivatives of a term are finitely many (Brzozowski).
+    """
+
+    def __init__(self):
+        self.kind: list[int] = []
+        self.left: list[int] = []
+        self.right: list[int] = []
+        self.children: list[tuple[int, ...]] = []
+        self.nullable: list[bool] = []
+        self.first: list[frozenset[int]] = []
+        self.ids: dict[tuple, int] = {}
+        self.by_symbol: dict[int, dict[int, list[int]]] = {}
+        self.derivatives: dict[tuple[int, int], int] = {}
+        self.partials: dict[tuple[int, int], frozenset[int]] = {}
+        self._add(("empty",), _EMPTY, False, frozenset())
+        self._add(("epsilon",), _EPS, True, frozenset())
+
+    def _add(
+        self,
+        key: tuple,
+        kind: int,
+        nullable: bool,
+        first: frozenset[int],
+        left: int = -1,
+        right: int = -1,
+        children: tuple[int, ...] = (),
+    ) -> int:
+        term = self.ids.get(key)
+        if term is None:
+            term = self.ids[key] = len(self.kind)
+            self.kind.append(kind)
+            self.left.append(left)
+            self.right.append(right)
+            self.children.append(children)
+            self.nullable.append(nullable)
+            self.first.append(first)
+        return term
+
+    def symbol(self, symbol: int) -> int:
+        return self._add(("symbol", symbol), _SYMBOL, False, frozenset((symbol,)))
+
+    def cat(self, left: int, right: int) -> int:
+        if left == _EMPTY or right == _EMPTY:
+            return _EMPTY
+        if left == _EPS:
+            return right
+        if right == _EPS:
+            return left
+
+        factors = []
+        while self.kind[left] == _CAT:
+            factors.append(self.left[left])
+            left = self.right[left]
+        factors.append(left)
+        for factor in reversed(factors):
+            nullable = self.nullable[factor]
+            right = self._add(
+                ("cat", factor, right),
+                _CAT,
+                nullable and self.nullable[right],
+                self.first[factor] | self.first[right]
+                if nullable
+                else self.first[factor],
+                left=factor,
+                right=right,
+            )
+        return right
+
+    def alt(self, operands: Iterable[int]) -> int:
+        children = set()
+        for operand in operands:
+            if self.kind[operand] == _ALT:
+                children.update(self.children[operand])
+            elif operand != _EMPTY:
+                children.add(operand)
+        if not children:
+            return _EMPTY
+        if len(children) == 1:
+            return children.pop()
+
+        children = tuple(sorted(children))
+        return self._add(
+            ("alt", children),
+            _ALT,
+            any(self.nullable[child] for child in children),
+            frozenset().union(*(self.first[child] for child in children)),
+            children=children,
+        )
+
+    def star(self, term: int) -> int:
+        if term == _EMPTY:
+            return _EPS
+        if term == _EPS or self.kind[term] == _STAR_KIND:
+            return term
+        return self._add(("star", term), _STAR_KIND, True, self.first[term], left=term)
+
+    def summands(self, term: int) -> tuple[int, ...]:
+        if self.kind[term] == _ALT:
+            return self.children[term]
+        return () if term == _EMPTY else (term,)
+
+    def starting_with(self, term: int, symbol: int) -> list[int]:
+        """Children of the union `term` that can start with `symbol`."""
+        index = self.by_symbol.get(term)
+        if index is None:
+            index = self.by_symbol[term] = {}
+            for child in self.children[term]:
+                for first in self.first[child]:
+                    index.setdefault(first, []).append(child)
+        return index[symbol]
+
+    def derivative(self, term: int, symbol: int) -> int:
+        """Term of the words `w` such that `symbol w` is in the language of `term`."""
+        if symbol not in self.first[term]:
+            return _EMPTY
+        key = (term, symbol)
+        result = self.derivatives.get(key)
+        if result is not None:
+            return result
+
+        kind = self.kind[term]
+        if kind == _SYMBOL:
+            result = _EPS
+        elif kind == _STAR_KIND:
+            result = self.cat(self.derivative(self.left[term], symbol), term)
+        elif kind == _ALT:
+            result = self.alt(
+                self.derivative(child, symbol)
+                for child in self.starting_with(term, symbol)
+            )
+        else:
+            # d(f1 f2 ... fn) = d(f1) f2 ... fn | d(f2) f3 ... fn | ... while
+            # the factors before are nullable
+            parts = []
+            rest = term
+            while self.kind[rest] == _CAT and symbol in self.first[rest]:
+                factor, rest = self.left[rest], self.right[rest]
+                parts.append(self.cat(self.derivative(factor, symbol), rest))
+                if not self.nullable[factor]:
+                    break
+            else:
+                parts.append(self.derivative(rest, symbol))
+            result = self.alt(parts)
+
+        self.derivatives[key] = result
+        return result
+
+    def partial_derivatives(self, term: int, symbol: int) -> frozenset[int]:
+        """
+        Antimirov's partial derivatives: terms, none of them a union, whose
+        languages together are the derivative of `term`.
+        """
+        if symbol not in self.first[term]:
+            return frozenset()
+        key = (term, symbol)
+        result = self.partials.get(key)
+        if result is not None:
+            return result
+
+        kind = self.kind[term]
+        parts = set()
+        if kind == _SYMBOL:
+            parts.add(_EPS)
+        elif kind == _STAR_KIND:
+            for part in self.partial_derivatives(self.left[term], symbol):
+                parts.update(self.summands(self.cat(part, term)))
+        elif kind == _ALT:
+            for child in self.starting_with(term, symbol):
+                parts.update(self.partial_derivatives(child, symbol))
+        else:
+            rest = term
+            while self.kind[rest] == _CAT and symbol in self.first[rest]:
+                factor, rest = self.left[rest], self.right[rest]
+                for part in self.partial_derivatives(factor, symbol):
+                    parts.update(self.summands(self.cat(part, rest)))
+                if not self.nullable[factor]:
+                    break
+            else:
+                parts.update(self.partial_derivatives(rest, symbol))
+
+        result = self.partials[key] = frozenset(parts)
+        return result
+
+
+class _Parser:
+    """
+    Recursive descent over the tokens: union binds loosest, then
+    concatenation, then the postfix star. An operand missing at the end of a
+    group is the empty language, as in pyformlang.
+    """
+
+    def __init__(self, tokens: list[str], terms: _Terms, symbols: Interner):
+        self.tokens = tokens
+        self.pos = 0
+        self.terms = terms
+        self.symbols = symbols
+
+    def misformed(self) -> MisformedRegexError:
+        return MisformedRegexError(
+            "The regex is misformed here.", " ".join(self.tokens)
+        )
+
+    def peek(self) -> str | None:
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else None
+
+    def at_group_end(self) -> bool:
+        return self.peek() in (None, ")")
+
+    def parse(self) -> int:
+        if not self.tokens:
+            return _EMPTY
+        term = self.union()
+        if self.pos != len(self.tokens):
+            raise self.misformed()
+        return term
+
+    def union(self) -> int:
+        if self.at_group_end():
+            return _EMPTY
+        operands = [self.concatenation()]
+        while self.peek() in _UNION:
+            self.pos += 1
+            operands.append(_EMPTY if self.at_group_end() else self.concatenation())
+        return self.terms.alt(operands)
+
+    def concatenation(self) -> int:
+        factors = [self.starred()]
+        while not self.at_group_end() and self.peek() not in _UNION:
+            if self.peek() in _CONCATENATION:
+                self.pos += 1
+                if self.at_group_end():
+                    return _EMPTY
+            factors.append(self.starred())
+
+        term = factors.pop()
+        for factor in reversed(factors):
+            term = self.terms.cat(factor, term)
+        return term
+
+    def starred(self) -> int:
+        term = self.atom()
+        while self.peek() in _STAR:
+            self.pos += 1
+            term = self.terms.star(term)
+        return term
+
+    def atom(self) -> int:
+        token = self.peek()
+        if token is None or token == ")" or token in _UNION + _STAR + _CONCATENATION:
+            raise self.misformed()
+        self.pos += 1
+        if token == "(":
+            term = self.union()
+            if self.peek() != ")":
+                raise self.misformed()
+            self.pos += 1
+            return term
+        if token in _EPSILON:
+            return _EPS
+        if token[0] == "\\":
+            token = token[1:]
+        return self.terms.symbol(self.symbols.intern(token))
+
+
+class _Partition:
+    """
+    Refinable partition of `0..n-1` (Valmari and Lehtinen): the elements of a
+    set are contiguous in `elements`, marked ones are moved to its front.
+    """
+
+    def __init__(self, n: int):
+        self.elements = list(range(n))
+        self.location = list(range(n))
+        self.set_of = [0] * n
+        self.first = [0] if n else []
+        self.past = [n] if n else []
+        self.marked = [0] if n else []
+        self.touched: list[int] = []
+
+    def __len__(self) -> int:
+        return len(self.first)
+
+    def mark(self, element: int):
+        s = self.set_of[element]
+        i = self.location[element]
+        j = self.first[s] + self.marked[s]
+        other = self.elements[j]
+        self.elements[i], self.location[other] = other, i
+        self.elements[j], self.location[element] = element, j
+        if self.marked[s] == 0:
+            self.touched.append(s)
+        self.marked[s] += 1
+
+    def split(self):
+        """Split every touched set into its marked and unmarked parts."""
+        while self.touched:
+            s = self.touched.pop()
+            j = self.first[s] + self.marked[s]
+            self.marked[s] = 0
+            if j == self.past[s]:
+                continue
+            # the smaller part becomes the new set
+            if j - self.first[s] <= self.past[s] - j:
+                self.first.append(self.first[s])
+                self.past.append(j)
+                self.first[s] = j
+            else:
+                self.first.append(j)
+                self.past.append(self.past[s])
+                self.past[s] = j
+            new = len(self.first) - 1
+            self.marked.append(0)
+            for i in range(self.first[new], self.past[new]):
+                self.set_of[self.elements[i]] = new
+
+
+def _minimize(
+    states_count: int,
+    sources: list[int],
+    labels: list[int],
+    targets: list[int],
+    final_states: list[int],
+) -> _Partition:
+    """
+    Hopcroft-style minimization of a partial DFA whose states are all
+    reachable and co-reachable, in O(m log n) for m transitions.
+    """
+    blocks = _Partition(states_count)
+    for state in final_states:
+        blocks.mark(state)
+    blocks.split()
+
+    # transitions grouped by label are the initial cords
+    cords = _Partition(len(labels))
+    order = sorted(range(len(labels)), key=labels.__getitem__)
+    cords.elements = order
+    cords.first, cords.past, cords.marked = [], [], []
+    for i, transition in enumerate(order):
+        if i == 0 or labels[transition] != labels[order[i - 1]]:
+            cords.first.append(i)
+            cords.past.append(i)
+            cords.marked.append(0)
+        cords.past[-1] = i + 1
+        cords.set_of[transition] = len(cords.first) - 1
+        cords.location[transition] = i
+
+    incoming: list[list[int]] = [[] for _ in range(states_count)]
+    for transition, target in enumerate(targets):
+        incoming[target].append(transition)
+
+    block, cord = 1, 0
+    while cord < len(cords):
+        for i in range(cords.first[cord], cords.past[cord]):
+            blocks.mark(sources[cords.elements[i]])
+        blocks.split()
+        cord += 1
+        while block < len(blocks):
+            for i in range(blocks.first[block], blocks.past[block]):
+                for transition in incoming[blocks.elements[i]]:
+                    cords.mark(transition)
+            cords.split()
+            block += 1
+    return blocks
+
+
+@dataclass
+class RegexDFA:
+    """
+    Minimal DFA of a regex as transition arrays over interned symbols.
+    State 0 is the start state; the empty language has no states at all.
+    """
+
+    symbols: Interner
+    states_count: int
+    sources: np.ndarray
+    labels: np.ndarray
+    targets: np.ndarray
+    final_states: np.ndarray
+
+    def matrices(self) -> dict[Symbol, sp.csr_matrix]:
+        """Boolean transition matrix of every symbol."""
+        return _matrices(
+            self.symbols, self.states_count, self.sources, self.labels, self.targets
+        )
+
+
+@dataclass
+class RegexNFA:
+    """
+    Epsilon-free NFA of a regex as transition arrays over interned symbols,
+    with any number of start states.
+    """
+
+    symbols: Interner
+    states_count: int
+    sources: np.ndarray
+    labels: np.ndarray
+    targets: np.ndarray
+    start_states: np.ndarray
+    final_states: np.ndarray
+
+    def matrices(self) -> dict[Symbol, sp.csr_matrix]:
+        """Boolean transition matrix of every symbol."""
+        return _matrices(
+            self.symbols, self.states_count, self.sources, self.labels, self.targets
+        )
+
+
+def _matrices(
+    symbols: Interner,
+    states_count: int,
+    sources: np.ndarray,
+    labels: np.ndarray,
+    targets: np.ndarray,
+) -> dict[Symbol, sp.csr_matrix]:
+    n = states_count
+    return {
+        Symbol(value): sp.csr_matrix(
+            (
+                np.ones(int((labels == i).sum()), dtype=bool),
+                (sources[labels == i], targets[labels == i]),
+            ),
+            shape=(n, n),
+            dtype=bool,
+        )
+        for i, value in enumerate(symbols.values)
+    }
+
+
+def compile_regex(regex: str, max_states: int = None) -> RegexDFA | None:
+    """
+    Minimal DFA of a regex in pyformlang syntax, built without pyformlang:
+    the states are Brzozowski derivatives of the parsed regex, explored from
+    the regex itself, then merged by partition refinement.
+    None when more than `max_states` derivatives turn up before merging.
+    """
+    terms, symbols = _Terms(), Interner()
+    root = _Parser(tokenize_regex(regex), terms, symbols).parse()
+
+    states = Interner([root] if root != _EMPTY else [])
+    sources, labels, targets = [], [], []
+    for state, term in enumerate(states.values):
+        if max_states is not None and len(states) > max_states:
+            return None
+        for symbol in terms.first[term]:
+            sources.append(state)
+            labels.append(symbol)
+            targets.append(states.intern(terms.derivative(term, symbol)))
+    finals = [i for i, term in enumerate(states.values) if terms.nullable[term]]
+
+    blocks = _minimize(len(states), sources, labels, targets, finals)
+    # blocks renumbered so the start state is 0
+    number = list(range(len(blocks)))
+    if len(blocks) > 0:
+        start = blocks.set_of[0]
+        number[0], number[start] = start, 0
+    block_of = np.array(
+        [number[block] for block in blocks.set_of], dtype=np.int64
+    ).reshape(-1)
+
+    sources = np.array(sources, dtype=np.int64)
+    # one transition per block and label: the ones leaving a block's first state
+    leaders = np.array(
+        [blocks.elements[first] for first in blocks.first], dtype=np.int64
+    )
+    kept = np.isin(sources, leaders)
+    return RegexDFA(
+        symbols,
+        len(blocks),
+        block_of[sources[kept]],
+        np.array(labels, dtype=np.int64)[kept],
+        block_of[np.array(targets, dtype=np.int64)[kept]],
+        np.unique(block_of[np.array(finals, dtype=np.int64)]),
+    )
+
+
+def compile_regex_nfa(regex: str) -> RegexNFA:
+    """
+    Epsilon-free NFA of a regex in pyformlang syntax, without determinizing:
+    the states are Antimirov's partial derivatives, linear in the number of
+    symbols of the regex. The summands of a top-level union are the start
+    states.
+    """
+    terms, symbols = _Terms(), Interner()
+    root = _Parser(tokenize_regex(regex), terms, symbols).parse()
+
+    states = Interner(terms.summands(root))
+    starts = len(states)
+    sources, labels, targets = [], [], []
+    for state, term in enumerate(states.values):
+        for symbol in terms.first[term]:
+            for part in terms.partial_derivatives(term, symbol):
+                sources.append(state)
+                labels.append(symbol)
+                targets.append(states.intern(part))
+
+    return RegexNFA(
+        symbols,
+        len(states),
+        np.array(sources, dtype=np.int64),
+        np.array(labels, dtype=np.int64),
+        np.array(targets, dtype=np.int64),
+        np.arange(starts, dtype=np.int64),
+        np.array(
+            [i for i, term in enumerate(states.values) if terms.nullable[term]],
+            dtype=np.int64,
+        ),
+    )
@@ -1,12 +1,25 @@
-from project.task2 import regex_to_dfa, graph_to_nfa
+from project.matrix_format import resolve_format, refit_by_sp_format
+from project.interning import Interner, encode_graph
+from project.graph_index import GraphIndex, NodeStates
+from project.query_cache import canonical_regex, matrix_nbytes, query_cache
+from project.regex_compiler import (
+    RegexDFA,
+    RegexNFA,
+    compile_regex,
+    compile_regex_nfa,
+)
 import scipy.sparse as sp
 import numpy as np
 import functools
+import hashlib
 import operator
-from collections.abc import Iterable
+from collections.abc import Callable, Hashable, Iterable, Mapping
 from pyformlang.finite_automaton import Symbol, NondeterministicFiniteAutomaton, State
 from networkx import MultiDiGraph
 import itertools
+import json
+from pathlib import Path
+from dataclasses import dataclass
 from typing import Type
 
 
@@ -26,6 +39,56 @@ def get_edges_from_fa(
     return edges
 
 
+def encode_fa_edges(
+    fa: NondeterministicFiniteAutomaton,
+    state_idx: dict[State, int],
+    symbol_idx: dict[Symbol, int],
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    starts, labels, ends = [], [], []
+    for start_state, links in fa.to_dict().items():
+        start = state_idx[start_state]
+        for label, end_states in links.items():
+            if not isinstance(end_states, Iterable):
+                end_states = (end_states,)
+            for end_state in end_states:
+                starts.append(start)
+                labels.append(symbol_idx[label])
+                ends.append(state_idx[end_state])
+
+    return (
+        np.array(starts, dtype=np.int64),
+        np.array(labels, dtype=np.int64),
+        np.array(ends, dtype=np.int64),
+    )
+
+
+def get_matricies_by_labels(
+    starts: np.ndarray,
+    labels: np.ndarray,
+    ends: np.ndarray,
+    labels_count: int,
+    states_count: int,
+    sparse_format: Type[sp.spmatrix],
+) -> list:
+    order = np.argsort(labels, kind="stable")
+    bounds = np.concatenate(
+        ([0], np.cumsum(np.bincount(labels, minlength=labels_count)))
+    )
+    starts, ends = starts[order], ends[order]
+
+    return [
+        get_matrix_by_sp_format(
+            (
+                np.ones(bounds[i + 1] - bounds[i], dtype=bool),
+                (starts[bounds[i] : bounds[i + 1]], ends[bounds[i] : bounds[i + 1]]),
+            ),
+            (states_count, states_count),
+            sparse_format,
+        )
+        for i in range(labels_count)
+    ]
+
+
 def get_matrix_by_sp_format(arg1: any, shape: any, sparse_format: Type[sp.spmatrix]):
     if sparse_format in [sp.dok_matrix, sp.lil_matrix]:
         coo = sp.coo_matrix(arg1, shape, dtype=bool)
@@ -33,6 +96,55 @@ def get_matrix_by_sp_format(arg1: any, shape: any, sparse_format: Type[sp.spmatr
     return sparse_format(arg1, shape, dtype=bool)
 
 
+def kron_by_sp_format(a: any, b: any, sparse_format: Type[sp.spmatrix]):
+    if hasattr(sparse_format, "kron"):
+        return sparse_format.kron(a, b)
+    return sp.kron(a, b, format=sparse_format([[]]).getformat())
+
+
+def _json_value(value: Hashable) -> any:
+    # states and labels are written as JSON, with tuples as lists
+    if isinstance(value, tuple):
+        return [_json_value(item) for item in value]
+    if value is None or isinstance(value, (str, int, float)):
+        return value
+    if isinstance(value, np.integer):
+        return int(value)
+    raise ValueError(f"Cannot save a value of type {type(value).__name__}")
+
+
+def _hashable_value(value: any) -> Hashable:
+    if isinstance(value, list):
+        return tuple(_hashable_value(item) for item in value)
+    return value
+
+
+@dataclass
+class ClosureResult:
+    matrix: sp.spmatrix
+    iterations: int
+
+
+def closure_fixpoint(
+    matrix: sp.spmatrix, sparse_format: Type[sp.spmatrix] = None
+) -> ClosureResult:
+    """
+    Reflexive-transitive closure of a square boolean matrix by repeated squaring.
+    Squaring stops as soon as it adds no new pairs, so the number of products is
+    bounded by the logarithm of the longest shortest path, not by the matrix size.
+    """
+    n = matrix.shape[0]
+    closure = matrix + type(matrix)(sp.identity(n, dtype=bool))
+    iterations = 0
+
+    while True:
+        iterations += 1
+        squared = closure @ closure
+        if squared.nnz == closure.nnz:
+            return ClosureResult(closure, iterations)
+        closure = refit_by_sp_format(squared, sparse_format, "closure")
+
+
 class AdjacencyMatrixFA:
     def __init__(
         self,
@@ -40,7 +152,11 @@ class AdjacencyMatrixFA:
         sparse_format: Type[sp.spmatrix] = sp.csc_matrix,
     ):
         self.matricies = {}
-        self.sparse_format = sparse_format
+        self.sparse_format = resolve_format(sparse_format)
+        sparse_format = self.sparse_format
+        self.closure_iterations = 0
+        self.closure = None
+        self.in_edges_by_symbol = None
 
         if automation is None:
             self.states = {}
@@ -50,101 +166,514 @@ class AdjacencyMatrixFA:
             self.final_states = set()
             return
 
-        self.states = {st: i for (i, st) in enumerate(automation.states)}
-        self.idx_by_state = {i: st for (i, st) in enumerate(automation.states)}
+        self.states = Interner(automation.states)
+        self.idx_by_state = self.states.values
         self.states_count = len(self.states)
         self.alphabet = automation.symbols
 
-        edges = tuple(zip(*get_edges_from_fa(automation)))
-        column_states, symbols, row_states = ([], [], []) if not edges else edges
-        for s in self.alphabet:
-            mask = np.equal(list(symbols), s).astype(int)
-            if (
-                self.sparse_format == sp.dok_matrix
-                or self.sparse_format == sp.lil_matrix
-            ):
-                coo = sp.coo_matrix(
-                    (
-                        mask,
-                        (
-                            [self.states[state] for state in list(row_states)],
-                            [self.states[state] for state in list(column_states)],
-                        ),
-                    ),
-                    shape=(self.states_count, self.states_count),
-                )
-                self.matricies[s] = (
-                    coo.todok() if self.sparse_format == sp.dok_matrix else coo.tolil()
-                )
-            else:
-                self.matricies[s] = self.sparse_format(
-                    (
-                        mask,
-                        (
-                            [self.states[state] for state in list(column_states)],
-                            [self.states[state] for state in list(row_states)],
-                        ),
-                    ),
-                    shape=(self.states_count, self.states_count),
-                )
-            self.matricies[s] = get_matrix_by_sp_format(
-                (
-                    mask,
-                    (
-                        [self.states[state] for state in list(column_states)],
-                        [self.states[state] for state in list(row_states)],
-                    ),
-                ),
-                (self.states_count, self.states_count),
-                sparse_format,
-            )
+        symbols = Interner(self.alphabet)
+        starts, labels, ends = encode_fa_edges(automation, self.states.ids, symbols.ids)
+        label_matricies = get_matricies_by_labels(
+            starts, labels, ends, len(symbols), self.states_count, sparse_format
+        )
+        self.matricies = dict(zip(symbols.values, label_matricies))
 
         self.start_states = {self.states[key] for key in automation.start_states}
         self.final_states = {self.states[key] for key in automation.final_states}
 
+    def states_vector(self, states: Iterable[int]) -> np.ndarray:
+        vector = np.zeros(self.states_count, dtype=bool)
+        vector[list(states)] = True
+        return vector
+
+    def advance(self, front: np.ndarray, symbol: Symbol) -> np.ndarray:
+        matrix = self.matricies.get(symbol)
+        if matrix is None:
+            return np.zeros_like(front)
+        return np.asarray(front @ matrix).ravel() != 0
+
     def accepts(self, word: Iterable[Symbol]) -> bool:
-        symbols = list(word)
+        front = self.states_vector(self.start_states)
+
+        for symbol in word:
+            front = self.advance(front, symbol)
+            if not front.any():
+                return False
+
+        return bool(front[list(self.final_states)].any())
+
+    def accepts_many(self, words: Iterable[Iterable[Symbol]]) -> list[bool]:
+        # words are merged into a trie, so every shared prefix is advanced once
+        children: list[dict[Symbol, int]] = [{}]
+        word_ends: list[list[int]] = [[]]
+        result = []
 
-        configs = [(symbols, st) for st in self.start_states]
+        for i, word in enumerate(words):
+            node = 0
+            for symbol in word:
+                if symbol not in children[node]:
+                    children[node][symbol] = len(children)
+                    children.append({})
+                    word_ends.append([])
+                node = children[node][symbol]
+            word_ends[node].append(i)
+            result.append(False)
 
-        while len(configs) > 0:
-            rest, state = configs.pop()
+        final_states = list(self.final_states)
+        stack = [(0, self.states_vector(self.start_states))]
+        while stack:
+            node, front = stack.pop()
 
-            if len(rest) == 0 and state in self.final_states:
-                return True
+            if word_ends[node] and front[final_states].any():
+                for i in word_ends[node]:
+                    result[i] = True
 
-            for assume_next in self.states.values():
-                if self.matricies[rest[0]][state, assume_next]:
-                    configs.append((rest[1:], assume_next))
+            for symbol, child in children[node].items():
+                next_front = self.advance(front, symbol)
+                if next_front.any():
+                    stack.append((child, next_front))
 
-        return False
+        return result
 
     def is_empty(self) -> bool:
-        tr_clos = self.transitive_closure()
+        final = self.states_vector(self.final_states)
+        front = self.states_vector(self.start_states)
+        visited = front.copy()
 
-        for st, fn in itertools.product(self.start_states, self.final_states):
-            if tr_clos[st, fn]:
+        while front.any():
+            if (front & final).any():
                 return False
 
+            reached = functools.reduce(
+                operator.or_,
+                (self.advance(front, symbol) for symbol in self.matricies),
+                np.zeros_like(front),
+            )
+            front = reached & ~visited
+            visited |= front
+
         return True
 
     def transitive_closure(self):
         n = self.states_count
         matrices = list(self.matricies.values())
 
-        common_matrix = self.sparse_format(
-            (np.ones(n, dtype=bool), (range(n), range(n))), shape=(n, n)
+        common_matrix = get_matrix_by_sp_format((n, n), None, self.sparse_format)
+
+        result = closure_fixpoint(
+            functools.reduce(operator.add, matrices, common_matrix), self.sparse_format
+        )
+        self.closure_iterations = result.iterations
+        self.closure = result.matrix
+
+        return result.matrix
+
+    def patch_closure(self, delta: any) -> any:
+        """
+        Add the transitions of `delta` to the kept closure and return the
+        pairs that became reachable. Only the rows of the closure ending in
+        a source of `delta` and the rows starting at its targets are read.
+        """
+        n = self.states_count
+        rows, columns = (np.unique(np.asarray(x)) for x in delta.nonzero())
+        added = get_matrix_by_sp_format((n, n), None, self.sparse_format)
+        if len(rows) == 0:
+            return added
+
+        def selector(idx: np.ndarray):
+            ones = np.ones(len(idx), dtype=bool)
+            positions = np.arange(len(idx))
+            return get_matrix_by_sp_format(
+                (ones, (idx, positions)), (n, len(idx)), self.sparse_format
+            )
+
+        def product(a: any, b: any) -> any:
+            return refit_by_sp_format(left_multiply(a, b), self.sparse_format, "delta")
+
+        # a new path goes C -> (delta C)* -> delta -> C; the starred part
+        # only moves between sources of delta, so it is a |rows| x |rows| closure
+        into_rows = product(self.closure, selector(rows))
+        step = product(delta[rows], selector(columns))
+        from_columns = self.closure[columns]
+        back = product(from_columns, selector(rows))
+        hops = closure_fixpoint(product(step, back), self.sparse_format).matrix
+
+        reached = product(product(into_rows, hops), product(step, from_columns))
+        added = refit_by_sp_format(reached > self.closure, self.sparse_format, "delta")
+        self.closure = refit_by_sp_format(
+            self.closure + added, self.sparse_format, "closure"
+        )
+        return added
+
+    def save(self, path: str | Path):
+        """
+        Write the automaton to the directory `path`: the CSR arrays of all
+        labels concatenated, with row pointers kept for non-empty rows only,
+        plus start/final states and the state map.
+        """
+        path = Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+        n = self.states_count
+        symbols = list(self.matricies)
+
+        matricies = []
+        for symbol in symbols:
+            matrix = sp.csr_matrix(self.matricies[symbol].tocsr(), dtype=bool)
+            matrix.sum_duplicates()
+            matrix.eliminate_zeros()
+            matricies.append(matrix)
+
+        # scipy keeps indices and indptr in one dtype, and the row pointers
+        # of a label go up to its nnz
+        nnz = max((matrix.nnz for matrix in matricies), default=0)
+        index_dtype = np.int32 if max(n, nnz) < np.iinfo(np.int32).max else np.int64
+        offsets = np.cumsum([0] + [matrix.nnz for matrix in matricies])
+        counts = [np.diff(matrix.indptr) for matrix in matricies]
+        rows = [np.flatnonzero(count) for count in counts]
+        row_offsets = np.cumsum([0] + [len(label_rows) for label_rows in rows])
+        empty = [np.zeros(0, index_dtype)]
+        indices = np.concatenate([matrix.indices for matrix in matricies] + empty)
+
+        np.save(path / "offsets.npy", offsets.astype(np.int64))
+        np.save(path / "row_offsets.npy", row_offsets.astype(np.int64))
+        np.save(path / "rows.npy", np.concatenate(rows + empty).astype(index_dtype))
+        np.save(
+            path / "row_counts.npy",
+            np.concatenate(
+                [count[label_rows] for count, label_rows in zip(counts, rows)] + empty
+            ).astype(index_dtype),
+        )
+        np.save(path / "indices.npy", indices.astype(index_dtype))
+        np.save(path / "data.npy", np.ones(len(indices), dtype=bool))
+        for name, states in [
+            ("start", self.start_states),
+            ("final", self.final_states),
+        ]:
+            np.save(path / f"{name}_states.npy", np.array(sorted(states), np.int64))
+
+        # pyformlang objects cache their hash, which is only valid in the
+        # process that computed it, so only their values are written
+        states = [self.idx_by_state[i] for i in range(n)]
+        pairs = bool(states) and isinstance(states[0], tuple)
+        state_values = [
+            tuple(st.value for st in state) if pairs else state.value
+            for state in states
+        ]
+        values = None
+        if not pairs and all(isinstance(value, int) for value in state_values):
+            values = np.array(state_values, dtype=np.int64)
+            np.save(path / "state_values.npy", values)
+            order = np.argsort(values, kind="stable")
+            np.save(path / "state_order.npy", order)
+            np.save(path / "state_sorted.npy", values[order])
+
+        meta = {
+            "states_count": n,
+            "symbols": [_json_value(symbol.value) for symbol in symbols],
+            "alphabet": [_json_value(symbol.value) for symbol in self.alphabet],
+            "pairs": pairs,
+            "states": None
+            if values is not None
+            else [_json_value(value) for value in state_values],
+        }
+        with open(path / "meta.json", "w") as file:
+            json.dump(meta, file)
+
+    @classmethod
+    def load(
+        cls,
+        path: str | Path,
+        mmap: bool = True,
+        sparse_format: Type[sp.spmatrix] = sp.csr_matrix,
+    ) -> "AdjacencyMatrixFA":
+        """
+        Read an automaton written by `save`. With `mmap` the arrays are
+        memory-mapped read-only, so CSR matrices share the pages of the files.
+        """
+        path = Path(path)
+        mmap_mode = "r" if mmap else None
+        with open(path / "meta.json") as file:
+            meta = json.load(file)
+
+        def array(name: str) -> np.ndarray:
+            return np.load(path / f"{name}.npy", mmap_mode=mmap_mode)
+
+        fa = cls(sparse_format=sparse_format)
+        n = fa.states_count = meta["states_count"]
+        fa.alphabet = {Symbol(_hashable_value(value)) for value in meta["alphabet"]}
+        fa.start_states = set(array("start_states").tolist())
+        fa.final_states = set(array("final_states").tolist())
+
+        if meta["states"] is None:
+            values = array("state_values")
+            fa.states = ValueStates(values, array("state_order"), array("state_sorted"))
+            fa.idx_by_state = ValueStatesByIdx(values)
+        else:
+            states = [
+                tuple(map(State, value)) if meta["pairs"] else State(value)
+                for value in map(_hashable_value, meta["states"])
+            ]
+            fa.states = Interner(states)
+            fa.idx_by_state = fa.states.values
+
+        offsets, row_offsets = array("offsets"), array("row_offsets")
+        rows, row_counts = array("rows"), array("row_counts")
+        indices, data = array("indices"), array("data")
+        for i, value in enumerate(meta["symbols"]):
+            lo, hi = offsets[i], offsets[i + 1]
+            row_lo, row_hi = row_offsets[i], row_offsets[i + 1]
+            indptr = np.zeros(n + 1, dtype=indices.dtype)
+            indptr[rows[row_lo:row_hi] + 1] = row_counts[row_lo:row_hi]
+            np.cumsum(indptr, out=indptr)
+            matrix = sp.csr_matrix(
+                (data[lo:hi], indices[lo:hi], indptr), shape=(n, n), copy=False
+            )
+            # saved canonical, so scipy never has to sort the read-only arrays
+            matrix.has_sorted_indices = True
+            matrix.has_canonical_format = True
+            if fa.sparse_format is not sp.csr_matrix:
+                matrix = get_matrix_by_sp_format(matrix, None, fa.sparse_format)
+            fa.matricies[Symbol(_hashable_value(value))] = matrix
+
+        return fa
+
+    @classmethod
+    def from_index(
+        cls,
+        index: GraphIndex,
+        start_nodes: set[int] = None,
+        final_nodes: set[int] = None,
+        sparse_format: Type[sp.spmatrix] = sp.csc_matrix,
+    ) -> "AdjacencyMatrixFA":
+        """
+        Graph automaton over the matrices of `index`, same language as
+        `graph_to_nfa`: empty or None start and final sets mean all nodes,
+        and start or final nodes missing from the graph are isolated states.
+        """
+        index = index.with_isolated(
+            itertools.chain(start_nodes or (), final_nodes or ())
         )
+        fa = cls(sparse_format=sparse_format)
+        fa.states = index.states
+        fa.idx_by_state = index.idx_by_state
+        fa.states_count = index.states_count
+        fa.alphabet = set(index.matricies)
+        fa.start_states = set(index.nodes_idx(start_nodes).tolist())
+        fa.final_states = set(index.nodes_idx(final_nodes).tolist())
+
+        # csr and csc matrices share the index arrays, updates replace them
+        in_edges = {s: m.T for s, m in index.transposed.items()}
+        fa.in_edges_by_symbol = in_edges
+        if fa.sparse_format is sp.csr_matrix:
+            fa.matricies = dict(index.matricies)
+        elif fa.sparse_format is sp.csc_matrix:
+            fa.matricies = dict(in_edges)
+        else:
+            fa.matricies = {
+                s: get_matrix_by_sp_format(m, None, fa.sparse_format)
+                for s, m in index.matricies.items()
+            }
+        return fa
+
+    @classmethod
+    def from_graph(
+        cls,
+        graph: MultiDiGraph,
+        start_nodes: set[int] = None,
+        final_nodes: set[int] = None,
+        sparse_format: Type[sp.spmatrix] = sp.csc_matrix,
+    ) -> "AdjacencyMatrixFA":
+        """
+        Automaton of `graph_to_nfa` read from the edge list straight into
+        matrices, without pyformlang objects; `to_nfa` builds them on request.
+        """
+        encoded = encode_graph(graph)
+        # like `graph_to_nfa`, start and final nodes missing from the graph
+        # become isolated states
+        encoded.nodes.intern_many(start_nodes or ())
+        encoded.nodes.intern_many(final_nodes or ())
+        return cls.from_index(
+            GraphIndex.from_encoded(encoded), start_nodes, final_nodes, sparse_format
+        )
+
+    def to_nfa(self) -> NondeterministicFiniteAutomaton:
+        """pyformlang automaton with the transitions, start and final states."""
+        idx_by_state = self.idx_by_state
+        nfa = NondeterministicFiniteAutomaton()
+        for symbol, matrix in self.matricies.items():
+            rows, columns = matrix.nonzero()
+            nfa.add_transitions(
+                (idx_by_state[i], symbol, idx_by_state[j])
+                for i, j in zip(np.asarray(rows).tolist(), np.asarray(columns).tolist())
+            )
+        for i in self.start_states:
+            nfa.add_start_state(idx_by_state[i])
+        for i in self.final_states:
+            nfa.add_final_state(idx_by_state[i])
+        return nfa
+
+    def with_format(self, sparse_format: Type[sp.spmatrix]) -> "AdjacencyMatrixFA":
+        """Copy sharing the states, with the matrices converted to `sparse_format`."""
+        fa = AdjacencyMatrixFA(sparse_format=sparse_format)
+        fa.states = self.states
+        fa.idx_by_state = self.idx_by_state
+        fa.states_count = self.states_count
+        fa.alphabet = set(self.alphabet)
+        fa.start_states = set(self.start_states)
+        fa.final_states = set(self.final_states)
+        fa.matricies = {
+            s: get_matrix_by_sp_format(m, None, fa.sparse_format)
+            for s, m in self.matricies.items()
+        }
+        return fa
 
-        return functools.reduce(operator.add, matrices, common_matrix) ** n
+    def nbytes(self) -> int:
+        return sum(matrix_nbytes(m) for m in self.matricies.values())
 
-    def update_matricies(self, delta: dict[Symbol, Type[sp.spmatrix]]):
+    def in_edges(self) -> dict[Symbol, sp.csc_matrix]:
+        """Transition matrices in CSC, to gather the in-edges of states."""
+        if self.in_edges_by_symbol is None:
+            self.in_edges_by_symbol = {
+                s: sp.csc_matrix(m.tocsc(), dtype=bool)
+                for s, m in self.matricies.items()
+            }
+        return self.in_edges_by_symbol
+
+    def update_matricies(self, delta: dict[Symbol, Type[sp.spmatrix]]) -> any:
+        """
+        Add `delta` to the transition matrices. If a closure is kept, it is
+        patched and the newly reachable pairs are returned.
+        """
+        self.in_edges_by_symbol = None
+        new_transitions = []
         for var, matrix in delta.items():
             if var in self.matricies:
+                if self.closure is not None:
+                    new_transitions.append(matrix > self.matricies[var])
                 self.matricies[var] += matrix
             else:
                 self.alphabet.add(var)
                 self.matricies[var] = matrix
+                new_transitions.append(matrix)
+
+        if self.closure is None:
+            return None
+
+        n = self.states_count
+        empty = get_matrix_by_sp_format((n, n), None, self.sparse_format)
+        return self.patch_closure(
+            functools.reduce(operator.add, new_transitions, empty)
+        )
+
+
+class ValueStates(Mapping):
+    """
+    State -> index map over an array of integer state values,
+    looked up by binary search in the sorted copy instead of a dict.
+    """
+
+    def __init__(
+        self, values: np.ndarray, order: np.ndarray, sorted_values: np.ndarray
+    ):
+        self.values = values
+        self.order = order
+        self.sorted_values = sorted_values
+
+    def __getitem__(self, state: State) -> int:
+        value = state.value if isinstance(state, State) else state
+        if not isinstance(value, (int, np.integer)):
+            raise KeyError(state)
+        pos = int(np.searchsorted(self.sorted_values, value))
+        if pos == len(self.values) or self.sorted_values[pos] != value:
+            raise KeyError(state)
+        return int(self.order[pos])
+
+    def lookup(self, values: Iterable[int]) -> np.ndarray:
+        values = np.fromiter(values, dtype=np.int64)
+        pos = np.searchsorted(self.sorted_values, values)
+        found = pos < len(self.values)
+        found[found] = self.sorted_values[pos[found]] == values[found]
+        if not found.all():
+            raise KeyError(State(int(values[~found][0])))
+        return self.order[pos].astype(np.int64)
+
+    def __iter__(self):
+        return (State(int(value)) for value in self.values)
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+
+class ValueStatesByIdx(Mapping):
+    def __init__(self, values: np.ndarray):
+        self.values = values
+
+    def __getitem__(self, idx: int) -> State:
+        return State(int(self.values[idx]))
+
+    def __iter__(self):
+        return iter(range(len(self.values)))
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+
+class ProductIndex:
+    """
+    Arithmetic numbering of the states of an intersection:
+    (i1, i2) <-> i1 * count2 + i2. Works elementwise on NumPy arrays.
+    """
+
+    def __init__(self, count1: int, count2: int):
+        self.count1 = count1
+        self.count2 = count2
+
+    def encode(self, idx1: any, idx2: any) -> any:
+        return np.asarray(idx1) * self.count2 + np.asarray(idx2)
+
+    def decode(self, idx: any) -> tuple[any, any]:
+        return np.divmod(idx, self.count2)
+
+    def __len__(self) -> int:
+        return self.count1 * self.count2
+
+
+class ProductStates(Mapping):
+    def __init__(
+        self,
+        index: ProductIndex,
+        automaton1: AdjacencyMatrixFA,
+        automaton2: AdjacencyMatrixFA,
+    ):
+        self.index = index
+        self.automaton1 = automaton1
+        self.automaton2 = automaton2
+
+    def __getitem__(self, key: tuple[State, State]) -> int:
+        state1, state2 = key
+        return int(
+            self.index.encode(
+                self.automaton1.states[state1], self.automaton2.states[state2]
+            )
+        )
+
+    def __iter__(self):
+        return itertools.product(self.automaton1.states, self.automaton2.states)
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+
+class ProductStatesByIdx(ProductStates):
+    def __getitem__(self, idx: int) -> tuple[State, State]:
+        idx1, idx2 = self.index.decode(idx)
+        return (
+            self.automaton1.idx_by_state[int(idx1)],
+            self.automaton2.idx_by_state[int(idx2)],
+        )
+
+    def __iter__(self):
+        return iter(range(len(self.index)))
 
 
 def intersect_automata(
@@ -154,79 +683,468 @@ def intersect_automata(
 ) -> AdjacencyMatrixFA:
     A1, A2 = automaton1.matricies, automaton2.matricies
 
-    intersect = AdjacencyMatrixFA()
+    intersect = AdjacencyMatrixFA(sparse_format=sparse_format)
 
     intersect.states_count = automaton1.states_count * automaton2.states_count
 
     for k in A1.keys():
         if A2.get(k) is None:
             continue
-        intersect.matricies[k] = sp.kron(
-            A1[k], A2[k], format=sparse_format([[]]).getformat()
+        intersect.matricies[k] = kron_by_sp_format(A1[k], A2[k], sparse_format)
+
+    index = ProductIndex(automaton1.states_count, automaton2.states_count)
+    intersect.index = index
+    intersect.states = ProductStates(index, automaton1, automaton2)
+    intersect.idx_by_state = ProductStatesByIdx(index, automaton1, automaton2)
+
+    def product_states(states1: Iterable[int], states2: Iterable[int]) -> list[int]:
+        idx1 = np.fromiter(states1, dtype=np.int64)
+        idx2 = np.fromiter(states2, dtype=np.int64)
+        return index.encode(idx1[:, None], idx2[None, :]).ravel().tolist()
+
+    intersect.start_states = product_states(
+        automaton1.start_states, automaton2.start_states
+    )
+    intersect.final_states = product_states(
+        automaton1.final_states, automaton2.final_states
+    )
+
+    intersect.alphabet = automaton1.alphabet.union(automaton2.alphabet)
+
+    return intersect
+
+
+def get_nodes_idx(
+    adj_matrix_by_graph: AdjacencyMatrixFA,
+    start_nodes: Iterable[int],
+    final_nodes: Iterable[int],
+) -> tuple[np.ndarray, np.ndarray]:
+    states = adj_matrix_by_graph.states
+    if isinstance(states, (ValueStates, NodeStates)):
+        return states.lookup(start_nodes), states.lookup(final_nodes)
+    return (
+        np.array([states[State(node)] for node in start_nodes], dtype=np.int64),
+        np.array([states[State(node)] for node in final_nodes], dtype=np.int64),
+    )
+
+
+def get_nodes_pairs(
+    adj_matrix_by_graph: AdjacencyMatrixFA, starts: np.ndarray, finals: np.ndarray
+) -> set[tuple[int, int]]:
+    idx_by_state = adj_matrix_by_graph.idx_by_state
+    return {
+        (idx_by_state[st].value, idx_by_state[fn].value)
+        for st, fn in set(zip(starts.tolist(), finals.tolist()))
+    }
+
+
+def left_multiply(operator: sp.spmatrix, matrix: any):
+    # scipy densifies formats it does not know, so let them multiply themselves
+    if sp.issparse(matrix) or isinstance(matrix, np.ndarray):
+        return operator @ matrix
+    return matrix.__rmatmul__(operator)
+
+
+class LazyIntersection:
+    """
+    Intersection of two automata that is never materialized.
+    A set of product states is a matrix X with rows indexed by the states of the
+    first automaton and columns by the states of the second one, so a step over
+    a symbol is A1ᵀ · X · A2. Independent sets can be stacked vertically as
+    equally sized blocks and advanced together.
+    """
+
+    def __init__(
+        self,
+        automaton1: AdjacencyMatrixFA,
+        automaton2: AdjacencyMatrixFA,
+        sparse_format: Type[sp.spmatrix] = sp.csc_matrix,
+    ):
+        self.automaton1 = automaton1
+        self.automaton2 = automaton2
+        self.sparse_format = resolve_format(sparse_format)
+        self.symbols = automaton1.matricies.keys() & automaton2.matricies.keys()
+        self.transposed = {
+            s: sp.csr_matrix(automaton1.matricies[s].tocsr().transpose(), dtype=bool)
+            for s in self.symbols
+        }
+        self.block_operators: dict[int, dict[Symbol, sp.csr_matrix]] = {}
+
+    def block_operator(self, symbol: Symbol, blocks: int) -> sp.csr_matrix:
+        if blocks not in self.block_operators:
+            identity = sp.identity(blocks, dtype=bool, format="csr")
+            self.block_operators[blocks] = {
+                s: sp.kron(identity, matrix, format="csr")
+                for s, matrix in self.transposed.items()
+            }
+        return self.block_operators[blocks][symbol]
+
+    def step(self, front: any, blocks: int = 1) -> any:
+        reached = get_matrix_by_sp_format(front.shape, None, self.sparse_format)
+        for s in self.symbols:
+            moved = front @ self.automaton2.matricies[s]
+            reached = reached + left_multiply(self.block_operator(s, blocks), moved)
+        return reached
+
+    def reachable(self, front: any, blocks: int = 1) -> any:
+        visited = front
+        while front.count_nonzero() > 0:
+            front = refit_by_sp_format(
+                self.step(front, blocks) > visited, self.sparse_format, "front"
+            )
+            visited = refit_by_sp_format(visited + front, self.sparse_format, "visited")
+        return visited
+
+
+def lazy_tensor_based_rpq(
+    adj_matrix_by_reg: AdjacencyMatrixFA,
+    adj_matrix_by_graph: AdjacencyMatrixFA,
+    start_nodes: set[int],
+    final_nodes: set[int],
+    sparse_format: Type[sp.spmatrix] = sp.csc_matrix,
+) -> set[tuple[int, int]]:
+    intersection = LazyIntersection(
+        adj_matrix_by_reg, adj_matrix_by_graph, sparse_format
+    )
+    reg_count = adj_matrix_by_reg.states_count
+
+    starts, finals = get_nodes_idx(adj_matrix_by_graph, start_nodes, final_nodes)
+    reg_starts = np.array(sorted(adj_matrix_by_reg.start_states), dtype=np.int64)
+    reg_finals = np.array(sorted(adj_matrix_by_reg.final_states), dtype=np.int64)
+
+    # one block of regex states per start node, seeded with the regex start states
+    blocks = np.arange(len(starts))
+    rows = (blocks[:, None] * reg_count + reg_starts[None, :]).ravel()
+    columns = np.repeat(starts, len(reg_starts))
+    front = get_matrix_by_sp_format(
+        (np.ones(len(rows), dtype=bool), (rows, columns)),
+        (len(starts) * reg_count, adj_matrix_by_graph.states_count),
+        sparse_format,
+    )
+
+    visited = intersection.reachable(front, len(starts))
+
+    final_rows = (blocks[:, None] * reg_count + reg_finals[None, :]).ravel()
+    reached_rows, reached_columns = visited[final_rows][:, finals].nonzero()
+
+    return get_nodes_pairs(
+        adj_matrix_by_graph,
+        starts[np.asarray(reached_rows) // max(len(reg_finals), 1)],
+        finals[np.asarray(reached_columns)],
+    )
+
+
+@dataclass(frozen=True)
+class CanonicalDFA:
+    """
+    Trimmed deterministic automaton with states numbered in BFS order from
+    the start state, following symbols in sorted order. Minimal DFAs of the
+    same language are equal in this form.
+    `transitions` are sorted (state, index in `symbols`, target) triples.
+    """
+
+    symbols: tuple
+    states_count: int
+    transitions: tuple[tuple[int, int, int], ...]
+    final_states: tuple[int, ...]
+
+    @property
+    def fingerprint(self) -> str:
+        text = repr((self.symbols, self.transitions, self.final_states))
+        return hashlib.sha256(text.encode()).hexdigest()
+
+    def to_fa(self, sparse_format: Type[sp.spmatrix] = sp.csr_matrix):
+        transitions = np.array(self.transitions, dtype=np.int64).reshape(-1, 3)
+        return fa_from_transitions(
+            self.symbols,
+            self.states_count,
+            transitions[:, 0],
+            transitions[:, 1],
+            transitions[:, 2],
+            [0] if self.states_count > 0 else [],
+            self.final_states,
+            sparse_format,
         )
 
-    intersect.states = {
-        (i1, i2): (
-            automaton1.states[i1] * automaton2.states_count + automaton2.states[i2]
+
+def fa_from_transitions(
+    symbols: list,
+    states_count: int,
+    sources: np.ndarray,
+    labels: np.ndarray,
+    targets: np.ndarray,
+    start_states: Iterable[int],
+    final_states: Iterable[int],
+    sparse_format: Type[sp.spmatrix] = sp.csr_matrix,
+) -> AdjacencyMatrixFA:
+    """Automaton over states `0..states_count-1` and `symbols[label]` transitions."""
+    n = states_count
+    fa = AdjacencyMatrixFA(sparse_format=sparse_format)
+    fa.states = Interner(State(i) for i in range(n))
+    fa.idx_by_state = fa.states.values
+    fa.states_count = n
+    fa.alphabet = {Symbol(value) for value in symbols}
+    fa.start_states = set(start_states)
+    fa.final_states = set(final_states)
+    matricies = get_matricies_by_labels(
+        sources, labels, targets, len(symbols), n, fa.sparse_format
+    )
+    fa.matricies = {Symbol(value): matrix for value, matrix in zip(symbols, matricies)}
+    return fa
+
+
+def canonical_transitions(
+    symbols: list,
+    states_count: int,
+    sources: np.ndarray,
+    labels: np.ndarray,
+    targets: np.ndarray,
+    start_states: Iterable[int],
+    final_states: Iterable[int],
+) -> CanonicalDFA:
+    """
+    `CanonicalDFA` of a deterministic automaton given as transitions over
+    `symbols[label]`, with at most one start state.
+    """
+    n = states_count
+    # symbols in sorted order, and out-edges of every state in that order
+    order = sorted(range(len(symbols)), key=lambda i: repr(symbols[i]))
+    rank = np.empty(len(symbols), dtype=np.int64)
+    rank[order] = np.arange(len(symbols))
+    labels = rank[labels]
+    edges = np.lexsort((labels, sources))
+    sources, labels, targets = sources[edges], labels[edges], targets[edges]
+    bounds = np.searchsorted(sources, np.arange(n + 1)).tolist()
+    labels, targets = labels.tolist(), targets.tolist()
+
+    # only states on some path from the start to a final state matter
+    incoming: list[list[int]] = [[] for _ in range(n)]
+    for source, target in zip(sources.tolist(), targets):
+        incoming[target].append(source)
+    alive = [False] * n
+    stack = list(final_states)
+    for state in stack:
+        alive[state] = True
+    while stack:
+        for source in incoming[stack.pop()]:
+            if not alive[source]:
+                alive[source] = True
+                stack.append(source)
+
+    queue = [start for start in start_states if alive[start]]
+    number = {state: i for i, state in enumerate(queue)}
+    transitions = []
+    for state in queue:
+        for i in range(bounds[state], bounds[state + 1]):
+            target = targets[i]
+            if not alive[target]:
+                continue
+            if target not in number:
+                number[target] = len(number)
+                queue.append(target)
+            transitions.append((number[state], labels[i], number[target]))
+
+    used = sorted({label for _, label, _ in transitions})
+    position = {label: i for i, label in enumerate(used)}
+    finals = sorted(number[state] for state in final_states if state in number)
+    return CanonicalDFA(
+        tuple(symbols[order[label]] for label in used),
+        len(queue),
+        tuple((s, position[label], t) for s, label, t in transitions),
+        tuple(finals),
+    )
+
+
+def canonical_dfa(dfa: AdjacencyMatrixFA) -> CanonicalDFA:
+    """`CanonicalDFA` of a deterministic automaton with at most one start state."""
+    symbols = list(dfa.matricies)
+    sources, labels, targets = [], [], []
+    for i, symbol in enumerate(symbols):
+        rows, columns = (np.asarray(x) for x in dfa.matricies[symbol].nonzero())
+        sources.append(rows)
+        labels.append(np.full(len(rows), i, dtype=np.int64))
+        targets.append(columns)
+    return canonical_transitions(
+        [symbol.value for symbol in symbols],
+        dfa.states_count,
+        np.concatenate(sources + [np.zeros(0, dtype=np.int64)]).astype(np.int64),
+        np.concatenate(labels + [np.zeros(0, dtype=np.int64)]),
+        np.concatenate(targets + [np.zeros(0, dtype=np.int64)]).astype(np.int64),
+        dfa.start_states,
+        dfa.final_states,
+    )
+
+
+def _compiled_regex(
+    regex: str, dfa: RegexDFA | None = None
+) -> tuple[str, AdjacencyMatrixFA]:
+    # `dfa` is the already compiled `compile_regex(regex)`, if any
+    def compile() -> tuple[str, AdjacencyMatrixFA]:
+        compiled = dfa if dfa is not None else compile_regex(regex)
+        canonical = canonical_transitions(
+            compiled.symbols.values,
+            compiled.states_count,
+            compiled.sources,
+            compiled.labels,
+            compiled.targets,
+            [0] if compiled.states_count > 0 else [],
+            compiled.final_states.tolist(),
         )
-        for i1, i2 in itertools.product(
-            automaton1.states.keys(), automaton2.states.keys()
+        # automata of equivalent regexes are compiled into one shared entry
+        fa = query_cache.get(
+            ("dfa", canonical.fingerprint), canonical.to_fa, AdjacencyMatrixFA.nbytes
         )
-    }
-    intersect.idx_by_state = {i: st for st, i in intersect.states.items()}
+        return canonical.fingerprint, fa
 
-    intersect.start_states = [
-        (s1 * automaton2.states_count + s2)
-        for s1, s2 in itertools.product(
-            automaton1.start_states, automaton2.start_states
-        )
-    ]
-    intersect.final_states = [
-        (f1 * automaton2.states_count + f2)
-        for f1, f2 in itertools.product(
-            automaton1.final_states, automaton2.final_states
+    return query_cache.get(
+        ("regex", canonical_regex(regex)), compile, lambda value: value[1].nbytes()
+    )
+
+
+def _compiled_regex_nfa(regex: str, nfa: RegexNFA | None = None) -> AdjacencyMatrixFA:
+    # `nfa` is the already compiled `compile_regex_nfa(regex)`, if any
+    def compile() -> AdjacencyMatrixFA:
+        compiled = nfa if nfa is not None else compile_regex_nfa(regex)
+        return fa_from_transitions(
+            compiled.symbols.values,
+            compiled.states_count,
+            compiled.sources,
+            compiled.labels,
+            compiled.targets,
+            compiled.start_states.tolist(),
+            compiled.final_states.tolist(),
         )
-    ]
 
-    intersect.alphabet = automaton1.alphabet.union(automaton2.alphabet)
+    return query_cache.get(
+        ("regex nfa", canonical_regex(regex)), compile, AdjacencyMatrixFA.nbytes
+    )
+
+
+def compiled_regex_nfa(
+    regex: str, sparse_format: Type[sp.spmatrix] = sp.csc_matrix
+) -> AdjacencyMatrixFA:
+    """
+    Epsilon-free NFA of `regex` as matrices, see `compile_regex_nfa`.
+    Kept in `query_cache` like `compiled_regex`, every call gets its own copy.
+    """
+    return _compiled_regex_nfa(regex).with_format(sparse_format)
 
-    return intersect
+
+def regex_fingerprint(regex: str) -> str:
+    """Hash of the minimal DFA of `regex`, equal for regexes of one language."""
+    return _compiled_regex(regex)[0]
+
+
+def compiled_regex(
+    regex: str, sparse_format: Type[sp.spmatrix] = sp.csc_matrix
+) -> AdjacencyMatrixFA:
+    """
+    Minimal DFA of `regex` as matrices, numbered as its `CanonicalDFA`.
+    Compiled automata are kept in `query_cache`, every call gets its own copy
+    in `sparse_format`.
+    """
+    return _compiled_regex(regex)[1].with_format(sparse_format)
+
+
+def cached_answer(
+    graph: MultiDiGraph | GraphIndex,
+    engine: str,
+    regex: str,
+    start_nodes: set[int],
+    final_nodes: set[int],
+    compute: Callable[[], set[tuple[int, int]]],
+) -> set[tuple[int, int]]:
+    """
+    Answer of a query on an index, kept in its `results` cache under the
+    regex fingerprint, so equivalent regexes share it. networkx graphs can
+    change between calls, their answers are always computed.
+    """
+    if not isinstance(graph, GraphIndex):
+        return compute()
+    key = (
+        engine,
+        regex_fingerprint(regex),
+        frozenset(start_nodes or ()),
+        frozenset(final_nodes or ()),
+    )
+    return set(graph.results.get(key, compute, lambda pairs: 64 * (len(pairs) + 1)))
+
+
+def graph_automaton(
+    graph: MultiDiGraph | GraphIndex,
+    start_nodes: set[int],
+    final_nodes: set[int],
+    sparse_format: Type[sp.spmatrix] = sp.csc_matrix,
+) -> AdjacencyMatrixFA:
+    if isinstance(graph, GraphIndex):
+        return AdjacencyMatrixFA.from_index(
+            graph, start_nodes, final_nodes, sparse_format
+        )
+    return AdjacencyMatrixFA.from_graph(graph, start_nodes, final_nodes, sparse_format)
 
 
 def tensor_based_rpq(
     regex: str,
-    graph: MultiDiGraph,
+    graph: MultiDiGraph | GraphIndex,
     start_nodes: set[int],
     final_nodes: set[int],
     sparse_format: Type[sp.spmatrix] = sp.csc_matrix,
+    lazy: bool = False,
 ) -> set[tuple[int, int]]:
-    adj_matrix_by_reg = AdjacencyMatrixFA(regex_to_dfa(regex), sparse_format)
-    adj_matrix_by_graph = AdjacencyMatrixFA(
-        graph_to_nfa(graph, start_nodes, final_nodes), sparse_format
+    return cached_answer(
+        graph,
+        "tensor",
+        regex,
+        start_nodes,
+        final_nodes,
+        lambda: _tensor_based_rpq(
+            regex, graph, start_nodes, final_nodes, sparse_format, lazy
+        ),
     )
 
+
+def _tensor_based_rpq(
+    regex: str,
+    graph: MultiDiGraph | GraphIndex,
+    start_nodes: set[int],
+    final_nodes: set[int],
+    sparse_format: Type[sp.spmatrix],
+    lazy: bool,
+) -> set[tuple[int, int]]:
+    sparse_format = resolve_format(sparse_format)
+    adj_matrix_by_reg = compiled_regex(regex, sparse_format)
+    adj_matrix_by_graph = graph_automaton(
+        graph, start_nodes, final_nodes, sparse_format
+    )
+
+    if lazy:
+        return lazy_tensor_based_rpq(
+            adj_matrix_by_reg,
+            adj_matrix_by_graph,
+            start_nodes,
+            final_nodes,
+            sparse_format,
+        )
+
     intersect = intersect_automata(
         adj_matrix_by_reg, adj_matrix_by_graph, sparse_format
     )
 
     tr_cl = intersect.transitive_closure()
 
-    reg_raw_start_states = [
-        key
-        for key in adj_matrix_by_reg.states
-        if adj_matrix_by_reg.states[key] in adj_matrix_by_reg.start_states
-    ]
-    reg_raw_final_states = [
-        key
-        for key in adj_matrix_by_reg.states
-        if adj_matrix_by_reg.states[key] in adj_matrix_by_reg.final_states
-    ]
+    index = intersect.index
+    starts, finals = get_nodes_idx(adj_matrix_by_graph, start_nodes, final_nodes)
+    reg_starts = np.fromiter(adj_matrix_by_reg.start_states, dtype=np.int64)
+    reg_finals = np.fromiter(adj_matrix_by_reg.final_states, dtype=np.int64)
+    if len(starts) == 0 or len(finals) == 0:
+        return set()
 
-    return {
-        (st, fn)
-        for (st, fn) in itertools.product(start_nodes, final_nodes)
-        for (st_reg, fn_reg) in itertools.product(
-            reg_raw_start_states, reg_raw_final_states
-        )
-        if tr_cl[intersect.states[(st_reg, st)], intersect.states[(fn_reg, fn)]]
-    }
+    rows = index.encode(reg_starts[:, None], starts[None, :]).ravel()
+    columns = index.encode(reg_finals[:, None], finals[None, :]).ravel()
+    reached_rows, reached_columns = tr_cl[rows][:, columns].nonzero()
+
+    return get_nodes_pairs(
+        adj_matrix_by_graph,
+        starts[np.asarray(reached_rows) % len(starts)],
+        finals[np.asarray(reached_columns) % len(finals)],
+    )
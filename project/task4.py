@@ -1,88 +1,424 @@
 import numpy as np
+from collections import Counter
+from collections.abc import Iterator
+from dataclasses import dataclass, field
 from typing import Type
 from networkx import MultiDiGraph
-from pyformlang.finite_automaton import Symbol
-from functools import reduce
 import scipy.sparse as sp
-from project.task2 import regex_to_dfa, graph_to_nfa
-from project.task3 import AdjacencyMatrixFA, get_matrix_by_sp_format
+from project.task3 import (
+    AdjacencyMatrixFA,
+    LazyIntersection,
+    _compiled_regex,
+    _compiled_regex_nfa,
+    cached_answer,
+    compiled_regex,
+    compiled_regex_nfa,
+    get_matrix_by_sp_format,
+    graph_automaton,
+)
+from project.graph_index import GraphIndex
+from project.matrix_format import resolve_format
+from project.query_cache import canonical_regex, query_cache
+from project.regex_compiler import compile_regex, compile_regex_nfa
 
 
 def _initial_front(
     dfa: AdjacencyMatrixFA,
-    dfa_start_state: int,
-    nfa: AdjacencyMatrixFA,
+    starts: np.ndarray,
+    nfa_states_count: int,
     sparse_format: Type[sp.spmatrix] = sp.csc_matrix,
 ):
-    nfa_st_states_count = len(nfa.start_states)
-    data = np.ones(nfa_st_states_count, dtype=bool)
-    rows = [dfa_start_state + dfa.states_count * i for i in range(nfa_st_states_count)]
-    columns = [st_state for st_state in nfa.start_states]
+    # one block per start node, seeded with every start state of the regex
+    # automaton, so an NFA works as well as a DFA
+    dfa_starts = np.array(sorted(dfa.start_states), dtype=np.int64)
+    blocks = np.arange(len(starts))
+    rows = (blocks[:, None] * dfa.states_count + dfa_starts[None, :]).ravel()
+    columns = np.repeat(starts, len(dfa_starts))
 
     return get_matrix_by_sp_format(
-        (data, (rows, columns)),
-        (dfa.states_count * nfa_st_states_count, nfa.states_count),
+        (np.ones(len(rows), dtype=bool), (rows, columns)),
+        (dfa.states_count * len(starts), nfa_states_count),
         sparse_format,
     )
 
 
+@dataclass
+class RegexPlan:
+    """
+    How the regex of a query runs through the product: "dfa" for its minimal
+    DFA, "nfa" for its epsilon-free NFA, with the sizes (states plus
+    transitions) the choice was made on. A size is None for an automaton
+    that was not built or whose construction was cut off.
+    """
+
+    mode: str
+    nfa_size: int | None = None
+    dfa_size: int | None = None
+
+
+def plan_regex(regex: str, max_growth: float = 2.0) -> RegexPlan:
+    """
+    Chooses between the minimal DFA and the NFA of `regex`. Every BFS level
+    costs a product per transition over fronts as tall as the automaton, so
+    the DFA is used unless it is more than `max_growth` times the size of
+    the NFA. Determinization stops as soon as the DFA gets that large, so
+    regexes like `(a|b)* a (a|b) ... (a|b)` never blow up.
+    The automaton chosen is put into `query_cache` right away, so the query
+    does not compile it again.
+    """
+
+    def compile() -> RegexPlan:
+        nfa = compile_regex_nfa(regex)
+        nfa_size = nfa.states_count + len(nfa.sources)
+        budget = int(max_growth * nfa_size)
+        dfa = compile_regex(regex, max_states=budget)
+        dfa_size = None if dfa is None else dfa.states_count + len(dfa.sources)
+        if dfa_size is not None and dfa_size <= budget:
+            _compiled_regex(regex, dfa)
+            return RegexPlan("dfa", nfa_size, dfa_size)
+        _compiled_regex_nfa(regex, nfa)
+        return RegexPlan("nfa", nfa_size, dfa_size)
+
+    return query_cache.get(
+        ("regex plan", canonical_regex(regex), max_growth), compile, lambda _: 64
+    )
+
+
+def _build_automata(
+    regex: str,
+    graph: MultiDiGraph | GraphIndex,
+    start_nodes: set[int],
+    final_nodes: set[int],
+    sparse_format: Type[sp.spmatrix],
+    regex_mode: str = "dfa",
+) -> tuple[AdjacencyMatrixFA, AdjacencyMatrixFA, RegexPlan]:
+    plan = plan_regex(regex) if regex_mode == "auto" else RegexPlan(regex_mode)
+    if plan.mode == "dfa":
+        adj_matrix_dfa = compiled_regex(regex, sparse_format)
+    elif plan.mode == "nfa":
+        adj_matrix_dfa = compiled_regex_nfa(regex, sparse_format)
+    else:
+        raise ValueError(f"Unknown regex mode: {regex_mode}")
+    adj_matrix_nfa = graph_automaton(graph, start_nodes, final_nodes, sparse_format)
+    return adj_matrix_dfa, adj_matrix_nfa, plan
+
+
+@dataclass
+class BfsStats:
+    """
+    Per-level trace of the hybrid MS-BFS: the direction taken, the size of the
+    front and the number of still unvisited cells when the choice was made.
+    `plan` tells how the regex was run.
+    """
+
+    directions: list[str] = field(default_factory=list)
+    front_sizes: list[int] = field(default_factory=list)
+    unvisited_sizes: list[int] = field(default_factory=list)
+    plan: RegexPlan = None
+
+    def record(self, direction: str, front_size: int, unvisited_size: int):
+        self.directions.append(direction)
+        self.front_sizes.append(front_size)
+        self.unvisited_sizes.append(unvisited_size)
+
+    def counts(self) -> Counter:
+        return Counter(self.directions)
+
+    @property
+    def switches(self) -> int:
+        return sum(a != b for a, b in zip(self.directions, self.directions[1:]))
+
+
+class CellSet:
+    """
+    Set of cells `row * width + column` out of `size`. Kept as sorted runs,
+    merged like a binary counter, while they take less memory than a bitmap
+    of all the cells, and as that bitmap afterwards: memory grows with the
+    cells added, up to the bitmap size.
+    """
+
+    def __init__(self, size: int):
+        self.size = size
+        self.count = 0
+        self.runs: list[np.ndarray] = []
+        self.bitmap: np.ndarray = None
+
+    def __len__(self) -> int:
+        return self.count
+
+    def to_bitmap(self) -> np.ndarray:
+        if self.bitmap is None:
+            self.bitmap = np.zeros(self.size, dtype=bool)
+            for run in self.runs:
+                self.bitmap[run] = True
+            self.runs = []
+        return self.bitmap
+
+    def contains(self, cells: np.ndarray) -> np.ndarray:
+        if self.bitmap is not None:
+            return self.bitmap[cells]
+        found = np.zeros(len(cells), dtype=bool)
+        for run in self.runs:
+            positions = np.minimum(np.searchsorted(run, cells), len(run) - 1)
+            found |= run[positions] == cells
+        return found
+
+    def add(self, cells: np.ndarray):
+        """Adds sorted cells that are not in the set yet."""
+        self.count += len(cells)
+        if self.bitmap is None and self.count * cells.itemsize >= self.size:
+            self.to_bitmap()
+        if self.bitmap is not None:
+            self.bitmap[cells] = True
+            return
+
+        run = cells
+        while self.runs and len(self.runs[-1]) <= len(run):
+            run = np.union1d(self.runs.pop(), run)
+        if len(run) > 0:
+            self.runs.append(run)
+
+
+def hybrid_levels(
+    intersection: LazyIntersection,
+    front: any,
+    blocks: int,
+    pull_ratio: float = 1 / 14,
+    stats: BfsStats = None,
+) -> Iterator[tuple[np.ndarray, np.ndarray]]:
+    """
+    BFS of `intersection.step` from `front`, yielding the coordinates of the
+    cells first reached at every level.
+    A level pushes the sparse front forward while it is small next to the
+    unvisited cells, and pulls otherwise: every column that still has
+    unvisited cells gathers its in-edges from the dense front.
+    Visited cells are a `CellSet`, sparse while the levels push. The dense
+    bitmap of the whole product is built on the first pull at the latest,
+    when the front already holds a `pull_ratio` share of the unvisited cells.
+    """
+    shape = front.shape
+    width = shape[1]
+    rows, columns = (np.asarray(x, dtype=np.int64) for x in front.nonzero())
+    visited = CellSet(shape[0] * width)
+    visited.add(np.sort(rows * width + columns))
+    yield rows, columns
+    unvisited_count = shape[0] * shape[1] - len(rows)
+    in_edges = None
+
+    while len(rows) > 0 and unvisited_count > 0:
+        pull = len(rows) > unvisited_count * pull_ratio
+        if stats is not None:
+            stats.record("pull" if pull else "push", len(rows), unvisited_count)
+
+        if pull:
+            if in_edges is None:
+                in_edges = intersection.automaton2.in_edges()
+            dense_visited = visited.to_bitmap().reshape(shape)
+            dense_front = np.zeros(shape, dtype=bool)
+            dense_front[rows, columns] = True
+            candidates = np.flatnonzero(~dense_visited.all(axis=0))
+
+            reached = np.zeros((shape[0], len(candidates)), dtype=bool)
+            for s in intersection.symbols:
+                moved = (in_edges[s][:, candidates].T @ dense_front.T).T
+                reached |= intersection.block_operator(s, blocks) @ moved
+            reached &= ~dense_visited[:, candidates]
+
+            rows, hits = np.nonzero(reached)
+            columns = candidates[hits]
+        else:
+            front = get_matrix_by_sp_format(
+                (np.ones(len(rows), dtype=bool), (rows, columns)),
+                shape,
+                intersection.sparse_format,
+            )
+            reached_rows, reached_columns = (
+                np.asarray(x, dtype=np.int64)
+                for x in intersection.step(front, blocks).nonzero()
+            )
+            new = ~visited.contains(reached_rows * width + reached_columns)
+            rows, columns = reached_rows[new], reached_columns[new]
+
+        visited.add(np.sort(rows * width + columns))
+        unvisited_count -= len(rows)
+        if len(rows) > 0:
+            yield rows, columns
+
+
+def hybrid_reachable(
+    intersection: LazyIntersection,
+    front: any,
+    blocks: int,
+    pull_ratio: float = 1 / 14,
+    stats: BfsStats = None,
+) -> tuple[np.ndarray, np.ndarray]:
+    """Coordinates of all the cells reachable from `front`."""
+    levels = list(hybrid_levels(intersection, front, blocks, pull_ratio, stats))
+    return (
+        np.concatenate([rows for rows, _ in levels]),
+        np.concatenate([columns for _, columns in levels]),
+    )
+
+
+def ms_bfs_rpq_arrays(
+    regex: str,
+    graph: MultiDiGraph | GraphIndex,
+    start_nodes: set[int],
+    final_nodes: set[int],
+    sparse_format: Type[sp.spmatrix] = sp.csc_matrix,
+    pull_ratio: float = 1 / 14,
+    stats: BfsStats = None,
+    regex_mode: str = "auto",
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Answer of `ms_bfs_based_rpq` as two aligned arrays of start and final nodes.
+    """
+    sparse_format = resolve_format(sparse_format)
+    adj_matrix_dfa, adj_matrix_nfa, plan = _build_automata(
+        regex, graph, start_nodes, final_nodes, sparse_format, regex_mode
+    )
+    if stats is not None:
+        stats.plan = plan
+    dfa_states_count = adj_matrix_dfa.states_count
+    nfa_states_count = adj_matrix_nfa.states_count
+    starts = np.fromiter(adj_matrix_nfa.start_states, dtype=np.int64)
+
+    front = _initial_front(adj_matrix_dfa, starts, nfa_states_count, sparse_format)
+    # every level is one product with the graph matrix and one with the
+    # block-diagonal I ⊗ DFAᵀ per symbol, whatever the number of start nodes
+    intersection = LazyIntersection(adj_matrix_dfa, adj_matrix_nfa, sparse_format)
+    rows, columns = hybrid_reachable(
+        intersection, front, len(starts), pull_ratio, stats
+    )
+
+    # reached cells of a final dfa state and a final vertex
+    block, dfa_state = np.divmod(rows, dfa_states_count)
+    dfa_final_mask = adj_matrix_dfa.states_vector(adj_matrix_dfa.final_states)
+    final_mask = adj_matrix_nfa.states_vector(adj_matrix_nfa.final_states)
+    found = dfa_final_mask[dfa_state] & final_mask[columns]
+
+    pairs = np.unique(starts[block[found]] * nfa_states_count + columns[found])
+    found_starts, found_finals = np.divmod(pairs, nfa_states_count)
+
+    idx, inverse = np.unique(
+        np.concatenate((found_starts, found_finals)), return_inverse=True
+    )
+    node_by_idx = adj_matrix_nfa.idx_by_state
+    # filled one by one: an object array keeps tuple and mixed-type ids as is
+    values = np.empty(len(idx), dtype=object)
+    for k, i in enumerate(idx.tolist()):
+        values[k] = node_by_idx[i].value
+    return values[inverse[: len(pairs)]], values[inverse[len(pairs) :]]
+
+
 def ms_bfs_based_rpq(
     regex: str,
-    graph: MultiDiGraph,
+    graph: MultiDiGraph | GraphIndex,
     start_nodes: set[int],
     final_nodes: set[int],
     sparse_format: Type[sp.spmatrix] = sp.csc_matrix,
+    pull_ratio: float = 1 / 14,
+    stats: BfsStats = None,
+    regex_mode: str = "auto",
 ) -> set[tuple[int, int]]:
-    adj_matrix_dfa = AdjacencyMatrixFA(regex_to_dfa(regex), sparse_format)
-    adj_matrix_nfa = AdjacencyMatrixFA(
-        graph_to_nfa(graph, start_nodes, final_nodes), sparse_format
-    )
+    """
+    RPQ by a multiple-source BFS over the product of the regex automaton
+    and the graph. `regex_mode` is "dfa" for the minimal DFA of `regex`,
+    "nfa" for its epsilon-free NFA, whose states are tracked as sets in the
+    product, or "auto" to let `plan_regex` choose.
+    """
 
-    transposed_matricies: dict[Symbol, Type[sp.spmatrix]] = {}
-    for symbol, matrix in adj_matrix_dfa.matricies.items():
-        transposed_matricies[symbol] = matrix.transpose()
+    def compute() -> set[tuple[int, int]]:
+        found_starts, found_finals = ms_bfs_rpq_arrays(
+            regex,
+            graph,
+            start_nodes,
+            final_nodes,
+            sparse_format,
+            pull_ratio,
+            stats,
+            regex_mode,
+        )
+        return set(zip(found_starts.tolist(), found_finals.tolist()))
 
-    dfa_states_count = adj_matrix_dfa.states_count
-    dfa_start_state = list(adj_matrix_dfa.start_states)[0]
+    # a cached answer would leave `stats` empty
+    if stats is not None:
+        return compute()
+    return cached_answer(graph, "ms-bfs", regex, start_nodes, final_nodes, compute)
 
-    nfa_start_states = adj_matrix_nfa.start_states
+
+def iter_ms_bfs_pairs(
+    adj_matrix_dfa: AdjacencyMatrixFA,
+    adj_matrix_nfa: AdjacencyMatrixFA,
+    starts: np.ndarray,
+    final_mask: np.ndarray,
+    sparse_format: Type[sp.spmatrix] = sp.csc_matrix,
+    pull_ratio: float = 1 / 14,
+    stats: BfsStats = None,
+) -> Iterator[tuple[np.ndarray, np.ndarray]]:
+    """
+    MS-BFS from the graph states `starts` over built automata. Yields, level
+    by level, positions in `starts` and the graph states in `final_mask`
+    they reach for the first time. Visited cells and yielded pairs are kept
+    sparse, so memory grows with what has been discovered, not with the
+    product; only a pull level builds dense bitmaps (see `hybrid_levels`).
+    """
+    sparse_format = resolve_format(sparse_format)
+    dfa_states_count = adj_matrix_dfa.states_count
+    dfa_final_mask = adj_matrix_dfa.states_vector(adj_matrix_dfa.final_states)
 
     front = _initial_front(
-        adj_matrix_dfa, dfa_start_state, adj_matrix_nfa, sparse_format
+        adj_matrix_dfa, starts, adj_matrix_nfa.states_count, sparse_format
+    )
+    intersection = LazyIntersection(adj_matrix_dfa, adj_matrix_nfa, sparse_format)
+
+    # (start position, vertex) pairs yielded so far, as sparse as the answer
+    reported = CellSet(len(starts) * adj_matrix_nfa.states_count)
+    levels = hybrid_levels(intersection, front, len(starts), pull_ratio, stats)
+    for rows, columns in levels:
+        block, dfa_state = np.divmod(rows, dfa_states_count)
+        found = dfa_final_mask[dfa_state] & final_mask[columns]
+        # several final dfa states of one block can reach the same vertex
+        pairs = np.unique(block[found] * adj_matrix_nfa.states_count + columns[found])
+        pairs = pairs[~reported.contains(pairs)]
+        reported.add(pairs)
+        if len(pairs) > 0:
+            yield np.divmod(pairs, adj_matrix_nfa.states_count)
+
+
+def iter_ms_bfs_rpq(
+    regex: str,
+    graph: MultiDiGraph | GraphIndex,
+    start_nodes: set[int],
+    final_nodes: set[int],
+    sparse_format: Type[sp.spmatrix] = sp.csc_matrix,
+    pull_ratio: float = 1 / 14,
+    stats: BfsStats = None,
+    regex_mode: str = "auto",
+) -> Iterator[tuple[int, int]]:
+    """
+    Same pairs as `ms_bfs_based_rpq`, yielded at the BFS level where they are
+    first reached. The search only advances while the caller keeps iterating.
+    """
+    sparse_format = resolve_format(sparse_format)
+    adj_matrix_dfa, adj_matrix_nfa, plan = _build_automata(
+        regex, graph, start_nodes, final_nodes, sparse_format, regex_mode
+    )
+    if stats is not None:
+        stats.plan = plan
+    starts = np.fromiter(adj_matrix_nfa.start_states, dtype=np.int64)
+    final_mask = adj_matrix_nfa.states_vector(adj_matrix_nfa.final_states)
+    node_by_idx = adj_matrix_nfa.idx_by_state
+
+    pairs = iter_ms_bfs_pairs(
+        adj_matrix_dfa,
+        adj_matrix_nfa,
+        starts,
+        final_mask,
+        sparse_format,
+        pull_ratio,
+        stats,
     )
-    visited = front
-
-    symbols = adj_matrix_dfa.matricies.keys() & adj_matrix_nfa.matricies.keys()
-
-    while front.count_nonzero() > 0:
-        next_fronts: dict[Symbol, Type[sp.spmatrix]] = {}
-        for s in symbols:
-            next_fronts[s] = front @ adj_matrix_nfa.matricies[s]
-
-            for i in range(len(nfa_start_states)):
-                next_fronts[s][i * dfa_states_count : (i + 1) * dfa_states_count] = (
-                    transposed_matricies[s]
-                    @ next_fronts[s][dfa_states_count * i : dfa_states_count * (i + 1)]
-                )
-
-        front = reduce(lambda x, y: x + y, next_fronts.values(), front)
-        front = front > visited
-        visited += front
-
-    result = set()
-    reversed_nfa_states = {value: key for key, value in adj_matrix_nfa.states.items()}
-
-    for dfa_fn_state in adj_matrix_dfa.final_states:
-        for i, nfa_start_state in enumerate(nfa_start_states):
-            for nfa_reached in visited.getrow(
-                dfa_states_count * i + dfa_fn_state
-            ).indices:
-                if nfa_reached in adj_matrix_nfa.final_states:
-                    result.add(
-                        (
-                            reversed_nfa_states[nfa_start_state],
-                            reversed_nfa_states[nfa_reached],
-                        )
-                    )
-
-    return result
+    for block, columns in pairs:
+        for i, j in zip(starts[block].tolist(), columns.tolist()):
+            yield node_by_idx[i].value, node_by_idx[j].value
@@ -1,5 +1,8 @@
 from pyformlang.cfg import CFG, Terminal, Production, Epsilon
 import networkx as nx
+from project.interning import Interner
+from project.query_cache import canonical_cfg, cfg_nbytes, query_cache
+from project.graph_index import GraphIndex, encoded_graph
 
 
 def cfg_to_weak_normal_form(cfg: CFG) -> CFG:
@@ -39,6 +42,13 @@ def cfg_to_weak_normal_form(cfg: CFG) -> CFG:
     return cfg
 
 
+def compiled_weak_normal_form(cfg: CFG) -> CFG:
+    """`cfg_to_weak_normal_form` kept in `query_cache`; the result is shared."""
+    return query_cache.get(
+        ("wnf", canonical_cfg(cfg)), lambda: cfg_to_weak_normal_form(cfg), cfg_nbytes
+    )
+
+
 def term_to_vars(cfg: CFG) -> dict:
     acc = {}
     for production in cfg.productions:
@@ -59,53 +69,71 @@ def vars_body_to_head(cfg: CFG) -> dict:
 
 def hellings_based_cfpq(
     cfg: CFG,
-    graph: nx.DiGraph,
+    graph: nx.DiGraph | GraphIndex,
     start_nodes: set[int] = None,
     final_nodes: set[int] = None,
 ) -> set[tuple[int, int]]:
-    wnf = cfg_to_weak_normal_form(cfg)
+    wnf = compiled_weak_normal_form(cfg)
 
-    edges = {(v1, Terminal(label), v2) for (v1, v2, label) in graph.edges.data("label")}
+    # nodes, labels and variables are ints from here on
+    encoded = encoded_graph(graph)
+    variables = Interner(wnf.variables)
 
     ttv = term_to_vars(wnf)
-    vbth = vars_body_to_head(wnf)
-
-    eval_edges = set(
-        {(v1, var, v2) for (v1, term, v2) in edges if term in ttv for var in ttv[term]}
-    )
+    vars_by_label = [
+        [variables.intern(var) for var in ttv.get(Terminal(label), ())]
+        for label in encoded.labels.values
+    ]
+    heads_by_body = {
+        (variables.intern(x), variables.intern(y)): [
+            variables.intern(var) for var in heads
+        ]
+        for (x, y), heads in vars_body_to_head(wnf).items()
+    }
 
-    for v in graph.nodes:
-        for var in wnf.get_nullable_symbols():
-            eval_edges.add((v, var, v))
+    eval_edges = set()
+    edges_queue = []
+    outgoing = [[] for _ in range(len(encoded.nodes))]
+    incoming = [[] for _ in range(len(encoded.nodes))]
 
-    edges_queue = list(eval_edges)
+    def add_edge(v1: int, var: int, v2: int):
+        if (v1, var, v2) not in eval_edges:
+            eval_edges.add((v1, var, v2))
+            edges_queue.append((v1, var, v2))
+            outgoing[v1].append((var, v2))
+            incoming[v2].append((v1, var))
 
-    def process_update(e1, e2, buffer: set):
-        st1, x, fn1 = e1
-        st2, y, fn2 = e2
-        xy = tuple([x, y])
+    edges = zip(
+        encoded.sources.tolist(), encoded.label_ids.tolist(), encoded.targets.tolist()
+    )
+    for v1, label, v2 in edges:
+        for var in vars_by_label[label]:
+            add_edge(v1, var, v2)
 
-        if st2 == fn1 and xy in vbth:
-            for var in vbth[xy]:
-                reduce_edge = (st1, var, fn2)
-                if reduce_edge not in eval_edges:
-                    buffer.add(reduce_edge)
-                    edges_queue.append(reduce_edge)
+    nullable = [variables.intern(var) for var in wnf.get_nullable_symbols()]
+    for v in range(len(encoded.nodes)):
+        for var in nullable:
+            add_edge(v, var, v)
 
     while edges_queue:
-        e1 = edges_queue.pop(0)
-        buffer = set()
-        for e2 in eval_edges:
-            process_update(e1, e2, buffer)
-            process_update(e2, e1, buffer)
-        eval_edges |= buffer
+        v1, x, v2 = edges_queue.pop()
+        # snapshots: edges added meanwhile are queued and meet this one later
+        for u, w in list(incoming[v1]):
+            for head in heads_by_body.get((w, x), ()):
+                add_edge(u, head, v2)
+        for y, v3 in list(outgoing[v2]):
+            for head in heads_by_body.get((x, y), ()):
+                add_edge(v1, head, v3)
+
+    start_var = variables.get(wnf.start_symbol)
+    start_mask = encoded.nodes.mask(start_nodes)
+    final_mask = encoded.nodes.mask(final_nodes)
+    node_by_idx = encoded.nodes.values
 
     pairs = {
-        (v1, v2)
+        (node_by_idx[v1], node_by_idx[v2])
         for v1, var, v2 in eval_edges
-        if v1 in start_nodes
-        and var.value == wnf.start_symbol.value
-        and v2 in final_nodes
+        if var == start_var and start_mask[v1] and final_mask[v2]
     }
 
     return pairs
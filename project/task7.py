@@ -1,55 +1,85 @@
 from pyformlang.cfg import CFG, Terminal
-from itertools import product
 import networkx as nx
-from scipy.sparse import csc_matrix
-from typing import Set
-from project.task6 import cfg_to_weak_normal_form, term_to_vars, vars_body_to_head
+import numpy as np
+import scipy.sparse as sp
+from typing import Set, Type
+from project.interning import Interner
+from project.matrix_format import refit_by_sp_format, resolve_format
+from project.graph_index import GraphIndex, encoded_graph
+from project.task3 import get_matrix_by_sp_format
+from project.task6 import compiled_weak_normal_form, term_to_vars, vars_body_to_head
 
 
 def matrix_based_cfpq(
     cfg: CFG,
-    graph: nx.DiGraph,
+    graph: nx.DiGraph | GraphIndex,
     start_nodes: Set[int] = None,
     final_nodes: Set[int] = None,
+    sparse_format: Type[sp.spmatrix] = sp.csc_matrix,
 ) -> set[tuple[int, int]]:
-    wnf = cfg_to_weak_normal_form(cfg)
+    sparse_format = resolve_format(sparse_format)
+    wnf = compiled_weak_normal_form(cfg)
     ttv = term_to_vars(wnf)
-    vbth = vars_body_to_head(wnf)
 
-    n = graph.number_of_nodes()
-    node_by_idx = {i: node for i, node in enumerate(graph.nodes)}
-    node_idx = {node: i for i, node in node_by_idx.items()}
+    # nodes, labels and variables are ints from here on
+    encoded = encoded_graph(graph)
+    variables = Interner(wnf.variables)
+    heads_by_body = {
+        (variables.intern(x), variables.intern(y)): [
+            variables.intern(var) for var in heads
+        ]
+        for (x, y), heads in vars_body_to_head(wnf).items()
+    }
+
+    n = len(encoded.nodes)
+    coords = [([], []) for _ in range(len(variables))]
 
-    matricies = {var: csc_matrix((n, n), dtype=bool) for var in wnf.variables}
+    for label_id, label in enumerate(encoded.labels.values):
+        edges = encoded.label_ids == label_id
+        for var in ttv.get(Terminal(label), set()):
+            rows, columns = coords[variables[var]]
+            rows.append(encoded.sources[edges])
+            columns.append(encoded.targets[edges])
 
-    for v1, v2, label in graph.edges.data("label"):
-        tv = ttv.get(Terminal(label), set())
-        i1, i2 = node_idx[v1], node_idx[v2]
-        for var in tv:
-            matricies[var][i1, i2] = True
+    for vn in wnf.get_nullable_symbols():
+        rows, columns = coords[variables[vn]]
+        rows.append(np.arange(n))
+        columns.append(np.arange(n))
 
-    for v, vn in product(graph.nodes, wnf.get_nullable_symbols()):
-        i = node_idx[v]
-        matricies[vn][i, i] = True
+    matricies = []
+    for rows, columns in coords:
+        rows = np.concatenate(rows + [np.zeros(0, dtype=np.int64)])
+        columns = np.concatenate(columns + [np.zeros(0, dtype=np.int64)])
+        matricies.append(
+            get_matrix_by_sp_format(
+                (np.ones(len(rows), dtype=bool), (rows, columns)), (n, n), sparse_format
+            )
+        )
 
-    updated = list(wnf.variables)
+    updated = list(range(len(variables)))
     while updated:
         cur = updated.pop(0)
-        for body, heads in vbth.items():
+        for body, heads in heads_by_body.items():
             if cur not in body:
                 continue
             for head in heads:
-                old_matrix = matricies[head]
-                matricies[head] += matricies[body[0]] @ matricies[body[1]]
-                if matricies[head].nnz > old_matrix.nnz:
+                before = matricies[head].nnz
+                matricies[head] = refit_by_sp_format(
+                    matricies[head] + matricies[body[0]] @ matricies[body[1]],
+                    sparse_format,
+                    "closure",
+                )
+                if matricies[head].nnz > before:
                     updated.append(head)
 
-    st = wnf.start_symbol
-    if st not in matricies:
+    st = variables.get(wnf.start_symbol)
+    if st is None:
         return set()
 
-    return {
-        (node_by_idx[i1], node_by_idx[i2])
-        for i1, i2 in zip(*matricies[st].nonzero())
-        if node_by_idx[i1] in start_nodes and node_by_idx[i2] in final_nodes
-    }
+    rows, columns = (np.asarray(x) for x in matricies[st].nonzero())
+    found = (
+        encoded.nodes.mask(start_nodes)[rows] & encoded.nodes.mask(final_nodes)[columns]
+    )
+    return set(
+        zip(encoded.nodes.decode(rows[found]), encoded.nodes.decode(columns[found]))
+    )
@@ -1,12 +1,25 @@
-import itertools
 import networkx as nx
-from scipy.sparse import csc_matrix
+import numpy as np
+import scipy.sparse as sp
+from typing import Type
 from pyformlang.finite_automaton import Symbol, State
 from pyformlang.rsa import RecursiveAutomaton
 from pyformlang.finite_automaton import NondeterministicFiniteAutomaton
 from pyformlang.cfg import CFG, Production
-from project.task3 import intersect_automata, AdjacencyMatrixFA, get_edges_from_fa
-from project.task2 import graph_to_nfa
+from project.task3 import (
+    intersect_automata,
+    AdjacencyMatrixFA,
+    get_edges_from_fa,
+    get_matrix_by_sp_format,
+    get_nodes_idx,
+    get_nodes_pairs,
+    graph_automaton,
+    kron_by_sp_format,
+)
+from project.graph_index import GraphIndex
+from project.interning import Interner
+from project.query_cache import canonical_cfg, canonical_regex, query_cache
+from project.matrix_format import resolve_format, refit_by_sp_format
 
 __all__ = ["cfg_to_rsm", "ebnf_to_rsm", "tensor_based_cfpq"]
 
@@ -19,7 +32,22 @@ def cfg_to_text(cfg: CFG) -> str:
     return "\n".join(productions) + "\n"
 
 
+def _rsm_nbytes(rsm: RecursiveAutomaton) -> int:
+    # a rough size of a state or a transition of a box
+    return 64 * sum(
+        len(box.dfa.states) + box.dfa.get_number_transitions()
+        for box in rsm.boxes.values()
+    )
+
+
 def cfg_to_rsm(cfg: CFG) -> RecursiveAutomaton:
+    """RSM of `cfg`, kept in `query_cache`; the result is shared."""
+    return query_cache.get(
+        ("cfg rsm", canonical_cfg(cfg)), lambda: _cfg_to_rsm(cfg), _rsm_nbytes
+    )
+
+
+def _cfg_to_rsm(cfg: CFG) -> RecursiveAutomaton:
     normalized_cfg = cfg.to_normal_form()
     if cfg.generate_epsilon():
         epsilon_production = Production(normalized_cfg.start_symbol, [])
@@ -31,7 +59,53 @@ def cfg_to_rsm(cfg: CFG) -> RecursiveAutomaton:
 
 
 def ebnf_to_rsm(ebnf: str) -> RecursiveAutomaton:
-    return RecursiveAutomaton.from_text(ebnf)
+    """RSM of `ebnf`, kept in `query_cache`; the result is shared."""
+    text = "\n".join(
+        canonical_regex(line) for line in ebnf.splitlines() if line.strip()
+    )
+    return query_cache.get(
+        ("ebnf rsm", text), lambda: RecursiveAutomaton.from_text(ebnf), _rsm_nbytes
+    )
+
+
+def rsm_key(rsm: RecursiveAutomaton) -> tuple:
+    """Initial label and the transitions, start and final states of every box."""
+    return (
+        rsm.initial_label.value,
+        frozenset(
+            (
+                label.value,
+                frozenset(
+                    (st1.value, symbol.value, st2.value)
+                    for st1, symbol, st2 in get_edges_from_fa(box.dfa)
+                ),
+                frozenset(state.value for state in box.start_state),
+                frozenset(state.value for state in box.final_states),
+            )
+            for label, box in rsm.boxes.items()
+        ),
+    )
+
+
+def compiled_rsm(
+    rsm: RecursiveAutomaton,
+) -> tuple[AdjacencyMatrixFA, Interner, np.ndarray]:
+    """
+    Matrices of `rsm` in CSR, the interned box labels and the box label id of
+    every state, kept in `query_cache`.
+    """
+
+    def compile() -> tuple[AdjacencyMatrixFA, Interner, np.ndarray]:
+        rsm_matrix = AdjacencyMatrixFA(rsm_to_nfa(rsm), sp.csr_matrix)
+        labels = Interner()
+        label_ids = labels.intern_many(
+            rsm_matrix.idx_by_state[i].value[0] for i in range(rsm_matrix.states_count)
+        )
+        return rsm_matrix, labels, label_ids
+
+    return query_cache.get(
+        ("rsm matrices", rsm_key(rsm)), compile, lambda value: value[0].nbytes()
+    )
 
 
 def rsm_to_nfa(rsm: RecursiveAutomaton) -> NondeterministicFiniteAutomaton:
@@ -63,12 +137,16 @@ def rsm_to_nfa(rsm: RecursiveAutomaton) -> NondeterministicFiniteAutomaton:
 
 def tensor_based_cfpq(
     rsm: RecursiveAutomaton,
-    graph: nx.DiGraph,
+    graph: nx.DiGraph | GraphIndex,
     start_nodes: set[int] = None,
     final_nodes: set[int] = None,
+    sparse_format: Type[sp.spmatrix] = sp.csc_matrix,
 ) -> set[tuple[int, int]]:
-    nfa = graph_to_nfa(graph, start_nodes, final_nodes)
-    return tensor_based_cfpq_nfa(rsm, nfa, start_nodes, final_nodes)
+    sparse_format = resolve_format(sparse_format)
+    graph_matrix = graph_automaton(graph, start_nodes, final_nodes, sparse_format)
+    return tensor_based_cfpq_fa(
+        rsm, graph_matrix, start_nodes, final_nodes, sparse_format
+    )
 
 
 def tensor_based_cfpq_nfa(
@@ -76,72 +154,92 @@ def tensor_based_cfpq_nfa(
     graph_nfa: NondeterministicFiniteAutomaton,
     start_nodes: set[int] = None,
     final_nodes: set[int] = None,
+    sparse_format: Type[sp.spmatrix] = sp.csc_matrix,
 ) -> set[tuple[int, int]]:
-    def get_graph_delta(
-        closure: csc_matrix, intersection: AdjacencyMatrixFA
-    ) -> dict[Symbol, csc_matrix]:
-        def unpack_state(state: State) -> tuple[State, State]:
-            return State(state[0]), State(state[1])
+    sparse_format = resolve_format(sparse_format)
+    graph_matrix = AdjacencyMatrixFA(graph_nfa, sparse_format)
+    return tensor_based_cfpq_fa(
+        rsm, graph_matrix, start_nodes, final_nodes, sparse_format
+    )
 
-        def get_label(state: State) -> Symbol:
-            return state.value.value[0]
 
-        delta = {}
-        for idx1, idx2 in zip(*closure.nonzero()):
-            state1, state2 = (
-                intersection.idx_by_state[idx1],
-                intersection.idx_by_state[idx2],
-            )
-            graph_state1, rsm_state1 = unpack_state(state1)
-            graph_state2, rsm_state2 = unpack_state(state2)
+def tensor_based_cfpq_fa(
+    rsm: RecursiveAutomaton,
+    graph_matrix: AdjacencyMatrixFA,
+    start_nodes: set[int] = None,
+    final_nodes: set[int] = None,
+    sparse_format: Type[sp.spmatrix] = sp.csc_matrix,
+) -> set[tuple[int, int]]:
+    """
+    CFPQ over a built graph automaton. Its matrices are extended with the
+    derived nonterminal edges, so it must not be shared between queries.
+    """
+    sparse_format = resolve_format(sparse_format)
 
-            graph_idx1, graph_idx2 = (
-                graph_matrix.states[graph_state1],
-                graph_matrix.states[graph_state2],
-            )
+    def get_graph_delta(closure: any, intersection: AdjacencyMatrixFA) -> dict:
+        rows, columns = closure.nonzero()
+        graph_idx1, rsm_idx1 = intersection.index.decode(np.asarray(rows))
+        graph_idx2, rsm_idx2 = intersection.index.decode(np.asarray(columns))
 
-            assert get_label(rsm_state1) == get_label(rsm_state2)
+        assert (rsm_label_ids[rsm_idx1] == rsm_label_ids[rsm_idx2]).all()
 
-            if not (
-                rsm_matrix.states[rsm_state1] in rsm_matrix.start_states
-                and rsm_matrix.states[rsm_state2] in rsm_matrix.final_states
-            ):
-                continue
+        found = rsm_start_mask[rsm_idx1] & rsm_final_mask[rsm_idx2]
+        found_labels = rsm_label_ids[rsm_idx1]
+        n = graph_matrix.states_count
 
-            label = get_label(rsm_state1)
-            n = len(graph_matrix.states)
-            if (
-                label not in graph_matrix.matricies
-                or not graph_matrix.matricies[label][graph_idx1, graph_idx2]
-            ):
-                delta.setdefault(label, csc_matrix((n, n), dtype=bool))[
-                    graph_idx1, graph_idx2
-                ] = True
+        delta = {}
+        for label_id in np.unique(found_labels[found]):
+            pairs = found & (found_labels == label_id)
+            label = rsm_labels.values[label_id]
+            matrix = get_matrix_by_sp_format(
+                (
+                    np.ones(pairs.sum(), dtype=bool),
+                    (graph_idx1[pairs], graph_idx2[pairs]),
+                ),
+                (n, n),
+                sparse_format,
+            )
+            if label in graph_matrix.matricies:
+                matrix = refit_by_sp_format(
+                    matrix > graph_matrix.matricies[label], sparse_format, "delta"
+                )
+            if matrix.count_nonzero() > 0:
+                delta[label] = matrix
 
         return delta
 
-    rsm_nfa = rsm_to_nfa(rsm)
-    graph_matrix = AdjacencyMatrixFA(graph_nfa)
-    rsm_matrix = AdjacencyMatrixFA(rsm_nfa)
+    compiled_matrix, rsm_labels, rsm_label_ids = compiled_rsm(rsm)
+    rsm_matrix = compiled_matrix.with_format(sparse_format)
+    rsm_start_mask = rsm_matrix.states_vector(rsm_matrix.start_states)
+    rsm_final_mask = rsm_matrix.states_vector(rsm_matrix.final_states)
 
+    # the intersection keeps its closure, every round only patches it with
+    # the product of the new graph edges and the rsm and looks at new pairs
+    intersection_matrix = intersect_automata(graph_matrix, rsm_matrix, sparse_format)
+    new_pairs = intersection_matrix.transitive_closure()
     while True:
-        intersection_matrix = intersect_automata(graph_matrix, rsm_matrix)
-        closure = intersection_matrix.transitive_closure()
-        graph_delta = get_graph_delta(closure, intersection_matrix)
+        graph_delta = get_graph_delta(new_pairs, intersection_matrix)
         if not graph_delta:
             break
         graph_matrix.update_matricies(graph_delta)
+        new_pairs = intersection_matrix.update_matricies(
+            {
+                label: kron_by_sp_format(
+                    matrix, rsm_matrix.matricies[label], sparse_format
+                )
+                for label, matrix in graph_delta.items()
+                if label in rsm_matrix.matricies
+            }
+        )
 
     start_symbol = rsm.initial_label
 
-    if start_symbol in graph_matrix.matricies:
-        start_matrix = graph_matrix.matricies[start_symbol]
-        return {
-            (start, final)
-            for start, final in itertools.product(start_nodes, final_nodes)
-            if start_matrix[
-                graph_matrix.states[State(start)], graph_matrix.states[State(final)]
-            ]
-        }
-
-    return set()
+    if start_symbol not in graph_matrix.matricies:
+        return set()
+
+    starts, finals = get_nodes_idx(graph_matrix, start_nodes, final_nodes)
+    start_matrix = graph_matrix.matricies[start_symbol]
+    rows, columns = start_matrix[starts][:, finals].nonzero()
+    return get_nodes_pairs(
+        graph_matrix, starts[np.asarray(rows)], finals[np.asarray(columns)]
+    )
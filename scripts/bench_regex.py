@@ -0,0 +1,54 @@
+import sys
+import time
+from collections.abc import Callable
+import shared
+
+sys.path.insert(0, str(shared.ROOT))
+
+from project.regex_compiler import compile_regex
+from project.task2 import regex_to_dfa
+
+SIZES = [10, 100, 1000, 10000]
+# pyformlang takes seconds at this size and overflows the stack at 1000
+PYFORMLANG_MAX_SIZE = 100
+
+
+def alternation(size: int) -> str:
+    """Star of a union of `size` distinct labels."""
+    return "(" + " | ".join(f"l{i}" for i in range(size)) + ")*"
+
+
+def chain(size: int) -> str:
+    """`size` labels over a small alphabet in a row."""
+    return " ".join("abcd"[i % 4] for i in range(size))
+
+
+def mixed(size: int) -> str:
+    """Groups of starred unions and single labels over a small alphabet."""
+    groups = []
+    for i in range(0, size, 5):
+        groups.append(f"(a | b{i % 7})* c{i % 5} (d | $) e")
+    return " ".join(groups)
+
+
+def measure(compile: Callable[[str], object], regex: str) -> float:
+    start = time.perf_counter()
+    compile(regex)
+    return time.perf_counter() - start
+
+
+def main():
+    print(f"{'regex':<12}{'size':>8}{'native, s':>12}{'pyformlang, s':>16}")
+    for family in [alternation, chain, mixed]:
+        for size in SIZES:
+            regex = family(size)
+            native = measure(compile_regex, regex)
+            if size <= PYFORMLANG_MAX_SIZE:
+                reference = f"{measure(regex_to_dfa, regex):.3f}"
+            else:
+                reference = "-"
+            print(f"{family.__name__:<12}{size:>8}{native:>12.3f}{reference:>16}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,23 @@
+import cfpq_data as cd
+from project.bidirectional_rpq import bidirectional_rpq
+from project.graph_index import GraphIndex
+from project.task4 import ms_bfs_based_rpq
+
+
+def test_bidirectional_matches_ms_bfs():
+    graph = cd.labeled_two_cycles_graph(20, 30, labels=("a", "b"))
+    index = GraphIndex(graph)
+    start_nodes, final_nodes = {0, 5, 33}, {0, 1, 12, 40, 50}
+
+    for regex in ["a*", "a* b b", "(a | b)* b a", "b a"]:
+        expected = ms_bfs_based_rpq(regex, graph, start_nodes, final_nodes)
+        assert bidirectional_rpq(regex, graph, start_nodes, final_nodes) == expected
+        assert bidirectional_rpq(regex, index, start_nodes, final_nodes) == expected
+
+
+def test_single_pair():
+    graph = cd.labeled_two_cycles_graph(20, 30, labels=("a", "b"))
+
+    assert bidirectional_rpq("a a a", graph, {1}, {4}) == {(1, 4)}
+    assert bidirectional_rpq("a a", graph, {1}, {4}) == set()
+    assert bidirectional_rpq("a*", graph, {3}, {3}) == {(3, 3)}
@@ -0,0 +1,53 @@
+import numpy as np
+import scipy.sparse as sp
+import pytest
+from project.bit_matrix import BitMatrix
+
+
+def random_bool(rows: int, columns: int, seed: int) -> sp.csr_matrix:
+    return sp.random(rows, columns, density=0.2, format="csr", random_state=seed) > 0
+
+
+@pytest.mark.parametrize("n, k, m", [(1, 1, 1), (5, 7, 3), (70, 130, 65), (3, 0, 2)])
+def test_operations_match_scipy(n, k, m):
+    a, b, c = random_bool(n, k, 1), random_bool(k, m, 2), random_bool(n, k, 3)
+    bit_a, bit_b = BitMatrix(a), BitMatrix(b)
+
+    assert bit_a.nnz == a.nnz
+    assert np.array_equal((bit_a @ bit_b).toarray(), (a @ b).toarray())
+    assert np.array_equal(np.asarray(a @ bit_b), (a @ b).toarray())
+    assert np.array_equal((bit_a + c).toarray(), (a + c).toarray())
+    assert np.array_equal((bit_a > c).toarray(), (a > c).toarray())
+    assert np.array_equal(bit_a.T.toarray(), a.T.toarray())
+    assert np.array_equal(
+        BitMatrix.kron(bit_a, c).toarray(), sp.kron(a, c).toarray() > 0
+    )
+
+
+def test_vector_products():
+    a = random_bool(40, 90, 4)
+    bit_a = BitMatrix(a)
+    right, left = np.arange(90) % 3 == 0, np.arange(40) % 2 == 0
+
+    assert np.array_equal(bit_a @ right, a @ right)
+    assert np.array_equal(left @ bit_a, left @ a)
+
+
+def test_coo_construction_and_indexing():
+    matrix = BitMatrix(([1, 0, 1], ([0, 1, 2], [64, 3, 0])), shape=(3, 65))
+
+    assert matrix.nnz == 2
+    assert matrix[0, 64] and matrix[2, 0] and not matrix[1, 3]
+    assert [list(x) for x in matrix.nonzero()] == [[0, 2], [64, 0]]
+
+
+@pytest.mark.parametrize("m", [1, 63, 64, 65, 130])
+def test_kron_crosses_word_boundaries(m):
+    a, b = random_bool(4, 5, 5), random_bool(3, m, 6)
+    product = BitMatrix.kron(BitMatrix(a), BitMatrix(b))
+
+    expected = sp.kron(a, b).toarray() > 0
+    assert np.array_equal(product.toarray(), expected)
+    # bits past the last column stay clear
+    assert product.nnz == expected.sum()
+    assert np.array_equal(product.T.toarray(), expected.T)
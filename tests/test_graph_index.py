@@ -0,0 +1,81 @@
+import networkx as nx
+import scipy.sparse as sp
+from pyformlang.cfg import CFG
+from pyformlang.finite_automaton import Symbol
+from project.graph_index import GraphIndex
+from project.task3 import tensor_based_rpq
+from project.task4 import ms_bfs_based_rpq
+from project.task6 import hellings_based_cfpq
+from project.task7 import matrix_based_cfpq
+from project.tensor_based_cfpq import cfg_to_rsm, tensor_based_cfpq
+
+
+def _graph() -> nx.MultiDiGraph:
+    graph = nx.MultiDiGraph()
+    graph.add_nodes_from(range(6))
+    graph.add_edges_from(
+        [
+            (0, 1, {"label": "a"}),
+            (1, 2, {"label": "a"}),
+            (1, 2, {"label": "a"}),
+            (2, 0, {"label": "b"}),
+            (2, 3, {"label": "epsilon"}),
+            (3, 4, {"label": "b"}),
+            (4, 5),
+        ]
+    )
+    return graph
+
+
+def test_index_matrices_and_statistics():
+    index = GraphIndex(_graph())
+
+    assert set(index.matricies) == {Symbol("a"), Symbol("b")}
+    assert index.edge_counts == {"a": 3, "b": 2, "epsilon": 1}
+    assert list(index.out_degree) == [1, 2, 2, 1, 0, 0]
+    assert list(index.in_degree) == [1, 1, 2, 1, 1, 0]
+    for symbol, matrix in index.matricies.items():
+        assert (index.transposed[symbol] != matrix.T).nnz == 0
+
+
+def test_engines_accept_index():
+    graph = _graph()
+    index = GraphIndex(graph)
+    cfg = CFG.from_text("S -> a S b | a b")
+
+    for starts, finals in [({0, 1}, {0, 4}), (set(), set())]:
+        for sparse_format in [sp.csr_matrix, sp.csc_matrix, "auto"]:
+            assert tensor_based_rpq(
+                "a* b", index, starts, finals, sparse_format
+            ) == tensor_based_rpq("a* b", graph, starts, finals, sparse_format)
+            assert matrix_based_cfpq(
+                cfg, index, starts, finals, sparse_format
+            ) == matrix_based_cfpq(cfg, graph, starts, finals, sparse_format)
+
+    starts, finals = {0, 1}, {0, 4}
+    assert ms_bfs_based_rpq("a* b", index, starts, finals) == ms_bfs_based_rpq(
+        "a* b", graph, starts, finals
+    )
+    assert hellings_based_cfpq(cfg, index, starts, finals) == hellings_based_cfpq(
+        cfg, graph, starts, finals
+    )
+    rsm = cfg_to_rsm(cfg)
+    assert tensor_based_cfpq(rsm, index, starts, finals) == tensor_based_cfpq(
+        rsm, graph, starts, finals
+    )
+    # queries leave the shared matrices untouched
+    assert set(index.matricies) == {Symbol("a"), Symbol("b")}
+
+
+def test_unknown_nodes_are_isolated():
+    graph = _graph()
+    index = GraphIndex(graph)
+    starts, finals = {0, 99}, {1, 99}
+
+    for engine in [tensor_based_rpq, ms_bfs_based_rpq]:
+        assert engine("a*", index, starts, finals) == {(0, 1), (99, 99)}
+        assert engine("a*", graph, starts, finals) == {(0, 1), (99, 99)}
+    assert tensor_based_rpq("a*", index, starts, set()) == tensor_based_rpq(
+        "a*", graph, starts, set()
+    )
+    assert 99 not in index.nodes
@@ -0,0 +1,28 @@
+import networkx as nx
+import numpy as np
+from project.interning import Interner, encode_graph
+
+
+def test_interner_round_trip():
+    interner = Interner(["b", "a"])
+
+    assert interner.intern("a") == 1 and interner.intern("c") == 2
+    assert list(interner.lookup_many(["c", "b"])) == [2, 0]
+    assert interner.decode(np.array([2, 1, 0])) == ["c", "a", "b"]
+    assert list(interner.mask({"a", "missing"})) == [False, True, False]
+    assert dict(interner) == {"b": 0, "a": 1, "c": 2}
+
+
+def test_encode_graph():
+    graph = nx.MultiDiGraph()
+    graph.add_edges_from([(10, 20, {"label": "x"}), (20, 10, {"label": "y"})])
+    graph.add_edge(20, 30, label="x")
+    encoded = encode_graph(graph)
+
+    edges = zip(
+        encoded.nodes.decode(encoded.sources),
+        encoded.nodes.decode(encoded.targets),
+        encoded.labels.decode(encoded.label_ids),
+    )
+    assert set(edges) == set(graph.edges.data("label"))
+    assert len(encoded.labels) == 2
@@ -0,0 +1,29 @@
+import cfpq_data as cd
+import scipy.sparse as sp
+from project.bit_matrix import BitMatrix
+from project.dense_matrix import DenseMatrix
+from project.matrix_format import FormatSelector
+from project.task3 import tensor_based_rpq
+from project.task4 import ms_bfs_based_rpq
+
+
+def test_choose_by_shape_and_density():
+    selector = FormatSelector(dense_cells=100, bit_density=0.1)
+
+    assert selector.choose((10, 10), 0) is DenseMatrix
+    assert selector.choose((100, 100), 5000) is BitMatrix
+    assert selector.choose((100, 100), 10) is sp.csr_matrix
+    assert selector.choose((1000, 100), 10) is sp.csc_matrix
+
+
+def test_auto_matches_fixed_format():
+    graph = cd.labeled_two_cycles_graph(20, 30, labels=("a", "b"))
+    nodes = set(graph.nodes)
+    selector = FormatSelector(dense_cells=256, bit_density=0.05)
+
+    for rpq in (tensor_based_rpq, ms_bfs_based_rpq):
+        expected = rpq("a* b", graph, nodes, nodes)
+        assert rpq("a* b", graph, nodes, nodes, "auto") == expected
+        assert rpq("a* b", graph, nodes, nodes, selector) == expected
+
+    assert len(selector.counts()) > 1
@@ -0,0 +1,35 @@
+import cfpq_data as cd
+from project.parallel_rpq import chunk_size_for_budget, parallel_ms_bfs_rpq
+from project.task4 import ms_bfs_based_rpq
+
+
+def test_chunk_size_for_budget():
+    # visited and pull fronts of 2 dfa states plus the reported pairs, 100 vertices
+    assert chunk_size_for_budget((3 * 2 + 2) * 100 * 10, 2, 100, workers=2) == 5
+    assert chunk_size_for_budget(3 * 2 * 100 * 10, 2, 100, workers=2) == 3
+    assert chunk_size_for_budget(1, 2, 100, workers=4) == 1
+
+
+def test_parallel_matches_sequential():
+    graph = cd.labeled_two_cycles_graph(30, 40, labels=("a", "b"))
+    start_nodes, final_nodes = set(range(0, 71, 4)), set(range(0, 71, 3))
+
+    for regex in ["a* b", "(a | b)* b a"]:
+        expected = ms_bfs_based_rpq(regex, graph, start_nodes, final_nodes)
+        # a budget of a few start nodes per chunk
+        actual = parallel_ms_bfs_rpq(
+            regex, graph, start_nodes, final_nodes, memory_budget=8000, max_workers=2
+        )
+        assert actual == expected
+
+
+def test_empty_sets_mean_all_nodes():
+    graph = cd.labeled_two_cycles_graph(5, 6, labels=("a", "b"))
+
+    for start_nodes, final_nodes in [(set(), set()), ({0, 3}, set()), (set(), {7})]:
+        expected = ms_bfs_based_rpq("a* b", graph, start_nodes, final_nodes)
+        assert expected
+        actual = parallel_ms_bfs_rpq(
+            "a* b", graph, start_nodes, final_nodes, memory_budget=2000, max_workers=2
+        )
+        assert actual == expected
@@ -0,0 +1,59 @@
+import cfpq_data as cd
+import networkx as nx
+from project.graph_index import GraphIndex
+from project.pruning import prune_graph, pruned_rpq, required_labels
+from project.task3 import compiled_regex, tensor_based_rpq
+from project.task4 import ms_bfs_based_rpq
+
+
+def test_required_labels():
+    assert required_labels(compiled_regex("a b* c")) == {"a", "c"}
+    assert required_labels(compiled_regex("(a | b) c*")) == set()
+    assert required_labels(compiled_regex("a (b | b c)")) == {"a", "b"}
+
+
+def test_prune_keeps_only_useful_nodes():
+    graph = nx.MultiDiGraph()
+    graph.add_edges_from(
+        [
+            ("s", "x", {"label": "a"}),
+            ("x", "f", {"label": "b"}),
+            ("s", "y", {"label": "c"}),
+            ("x", "z", {"label": "a"}),
+        ]
+    )
+
+    pruned = prune_graph("a* b", graph, {"s"}, {"f"})
+    assert sorted(pruned.nodes) == ["f", "s", "x"]
+    assert len(pruned.graph.encoded.sources) == 2
+    assert prune_graph("a d", graph, {"s"}, {"f"}) is None
+    assert pruned_rpq("a* b", graph, {"s"}, {"f"}) == {("s", "f")}
+
+
+def test_pruned_matches_full_graph():
+    graph = cd.labeled_two_cycles_graph(20, 30, labels=("a", "b"))
+    index = GraphIndex(graph)
+    start_nodes, final_nodes = {0, 3, 25}, {1, 7, 40}
+
+    for regex in ["a*", "a* b", "b b (a | b)", "a c"]:
+        for engine in [ms_bfs_based_rpq, tensor_based_rpq]:
+            expected = engine(regex, graph, start_nodes, final_nodes)
+            assert (
+                pruned_rpq(regex, graph, start_nodes, final_nodes, engine) == expected
+            )
+            assert (
+                pruned_rpq(regex, index, start_nodes, final_nodes, engine) == expected
+            )
+
+
+def test_pruning_keeps_unknown_nodes():
+    graph = cd.labeled_two_cycles_graph(3, 4, labels=("a", "b"))
+    index = GraphIndex(graph)
+    start_nodes, final_nodes = {0, 99}, {1, 99}
+
+    for target in [graph, index]:
+        expected = tensor_based_rpq("a*", target, start_nodes, final_nodes)
+        assert (99, 99) in expected
+        assert pruned_rpq("a*", target, start_nodes, final_nodes) == expected
+        assert pruned_rpq("a*", target, {99}, set()) == {(99, 99)}
+    assert 99 not in graph and 99 not in index.nodes
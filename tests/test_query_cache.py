@@ -0,0 +1,84 @@
+import networkx as nx
+import scipy.sparse as sp
+from pyformlang.cfg import CFG
+from project.graph_index import GraphIndex
+from project.query_cache import (
+    QueryCache,
+    canonical_cfg,
+    canonical_regex,
+    query_cache,
+)
+from project.task3 import compiled_regex, regex_fingerprint, tensor_based_rpq
+from project.task4 import plan_regex
+
+
+def test_lru_evicts_by_size():
+    cache = QueryCache(max_bytes=10)
+    compiled = []
+
+    def get(key: str, size: int) -> str:
+        return cache.get(
+            key, lambda: compiled.append(key) or key.upper(), lambda _: size
+        )
+
+    assert get("a", 4) == "A" and get("b", 4) == "B"
+    assert get("a", 4) == "A"
+    get("c", 4)
+    assert "b" not in cache.entries and "a" in cache.entries
+    get("huge", 11)
+    assert "huge" not in cache.entries
+
+    assert compiled == ["a", "b", "c", "huge"]
+    assert (cache.hits, cache.misses, cache.evictions) == (1, 4, 1)
+    assert cache.size == 8 and len(cache) == 2
+
+
+def test_equal_queries_share_compiled_automata():
+    query_cache.clear()
+    first = compiled_regex("(a | b)*  c", sp.csr_matrix)
+    hits = query_cache.hits
+    second = compiled_regex(" (a | b)* c", sp.csc_matrix)
+
+    assert query_cache.hits == hits + 1
+    assert isinstance(second.matricies[next(iter(second.matricies))], sp.csc_matrix)
+    assert first.matricies is not second.matricies
+
+    cfg1 = CFG.from_text("S -> a S b | $")
+    cfg2 = CFG.from_text("S -> $ | a S b")
+    assert canonical_cfg(cfg1) == canonical_cfg(cfg2)
+
+
+def test_only_spaces_are_collapsed():
+    assert canonical_regex("a\tb") != canonical_regex("a b")
+    assert canonical_regex("  a   b ") == canonical_regex("a b")
+
+    query_cache.clear()
+    hits = query_cache.hits
+    tab = compiled_regex("a\tb", sp.csr_matrix)
+    space = compiled_regex("a b", sp.csr_matrix)
+    assert query_cache.hits == hits
+    assert {symbol.value for symbol in tab.matricies} == {"a\tb"}
+    assert {symbol.value for symbol in space.matricies} == {"a", "b"}
+    assert plan_regex("a\tb").dfa_size != plan_regex("a b").dfa_size
+
+
+def test_equivalent_regexes_share_fingerprint():
+    assert regex_fingerprint("a | b") == regex_fingerprint("b | a")
+    assert regex_fingerprint("(a b)*") == regex_fingerprint("$ | a b (a b)*")
+    assert regex_fingerprint("a b") != regex_fingerprint("b a")
+    assert compiled_regex("a*").states_count == compiled_regex("a* a*").states_count
+
+
+def test_index_reuses_answers_of_equivalent_regexes():
+    graph = nx.MultiDiGraph()
+    graph.add_edges_from([(0, 1, {"label": "a"}), (1, 2, {"label": "b"})])
+    index = GraphIndex(graph)
+
+    first = tensor_based_rpq("a | a b", index, {0}, {1, 2})
+    misses = index.results.misses
+    second = tensor_based_rpq("a b | a", index, {0}, {2, 1})
+
+    assert first == second == {(0, 1), (0, 2)}
+    assert (index.results.hits, index.results.misses) == (1, misses)
+    second.clear()
+    assert tensor_based_rpq("a (b | $)", index, {0}, {1, 2}) == first
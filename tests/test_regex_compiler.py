@@ -0,0 +1,98 @@
+import random
+import pytest
+import scipy.sparse as sp
+from pyformlang.finite_automaton import Symbol
+from project.regex_compiler import compile_regex, compile_regex_nfa, tokenize_regex
+from project.task2 import regex_to_dfa
+from project.task3 import (
+    AdjacencyMatrixFA,
+    canonical_dfa,
+    canonical_transitions,
+    compiled_regex_nfa,
+)
+
+
+def _random_regex(rng: random.Random, depth: int) -> str:
+    choice = rng.random()
+    if depth == 0 or choice < 0.3:
+        return rng.choice(["a", "b", "c", "ab", "$", "epsilon", "\\*"])
+    left, right = _random_regex(rng, depth - 1), _random_regex(rng, depth - 1)
+    if choice < 0.55:
+        return left + rng.choice([" ", " . ", "."]) + right
+    if choice < 0.75:
+        return left + rng.choice([" | ", "|", " + "]) + right
+    if choice < 0.9:
+        return "(" + left + ")" + rng.choice(["*", " *", "**"])
+    return "(" + left + ")"
+
+
+def _native(regex: str):
+    dfa = compile_regex(regex)
+    return canonical_transitions(
+        dfa.symbols.values,
+        dfa.states_count,
+        dfa.sources,
+        dfa.labels,
+        dfa.targets,
+        [0] if dfa.states_count > 0 else [],
+        dfa.final_states.tolist(),
+    )
+
+
+def _pyformlang(regex: str):
+    return canonical_dfa(AdjacencyMatrixFA(regex_to_dfa(regex), sp.csr_matrix))
+
+
+def test_tokens_match_pyformlang():
+    assert tokenize_regex("ab|c*") == ["ab", "|", "c", "*"]
+    assert tokenize_regex("  a\\.b   (c)") == ["a\\.b", "(", "c", ")"]
+    assert tokenize_regex("") == []
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_same_minimal_dfa_as_pyformlang(seed: int):
+    rng = random.Random(seed)
+    regexes = ["", "a |", "(a|)b", "a b. c", "\\$ a", "a $ b", "(a b)* c"]
+    regexes += [_random_regex(rng, rng.randint(1, 6)) for _ in range(150)]
+
+    for regex in regexes:
+        assert _native(regex) == _pyformlang(regex), regex
+
+
+def test_misformed_regex():
+    for regex in ["a || b", "| a", "* a", "(a", "a )"]:
+        with pytest.raises(Exception):
+            regex_to_dfa(regex)
+        with pytest.raises(Exception):
+            compile_regex(regex)
+
+
+def test_matrices():
+    dfa = compile_regex("(a | b)* c")
+    matrices = dfa.matrices()
+
+    assert dfa.states_count == 2 and dfa.final_states.tolist() == [1]
+    assert set(matrices) == {Symbol("a"), Symbol("b"), Symbol("c")}
+    assert matrices[Symbol("a")][0, 0] and matrices[Symbol("c")][0, 1]
+    assert sum(m.nnz for m in matrices.values()) == 3
+
+
+def test_nfa_has_the_regex_language():
+    rng = random.Random(5)
+    regexes = ["a | b c", "(a b)* | $", "a $ b"]
+    regexes += [_random_regex(rng, rng.randint(1, 5)) for _ in range(100)]
+
+    for regex in regexes:
+        nfa = compiled_regex_nfa(regex, sp.csr_matrix).to_nfa()
+        determinized = AdjacencyMatrixFA(nfa.to_deterministic().minimize())
+        assert canonical_dfa(determinized) == _pyformlang(regex), regex
+
+
+def test_nfa_stays_small():
+    regex = "(a | b)* a" + " (a | b)" * 10
+    nfa = compile_regex_nfa(regex)
+
+    assert nfa.states_count == 13
+    assert compile_regex(regex, max_states=100) is None
+    assert nfa.start_states.tolist() == [0]
+    assert len(compile_regex_nfa("a | b c | $").start_states) == 3
@@ -0,0 +1,176 @@
+import json
+import pytest
+import cfpq_data as cd
+import networkx as nx
+import numpy as np
+import scipy.sparse as sp
+from pyformlang.finite_automaton import Symbol
+from project.task2 import regex_to_dfa, graph_to_nfa
+from project.task3 import (
+    AdjacencyMatrixFA,
+    closure_fixpoint,
+    intersect_automata,
+    tensor_based_rpq,
+)
+
+
+def test_closure_fixpoint_on_path():
+    n = 9
+    path = sp.csr_matrix(
+        ([True] * (n - 1), (range(n - 1), range(1, n))), shape=(n, n), dtype=bool
+    )
+    result = closure_fixpoint(path)
+
+    assert result.matrix.nnz == n * (n + 1) // 2
+    assert result.iterations == 4
+
+
+def test_transitive_closure_reports_iterations():
+    fa = AdjacencyMatrixFA(regex_to_dfa("a b c d"))
+    closure = fa.transitive_closure()
+
+    assert fa.closure_iterations > 0
+    for st in fa.start_states:
+        assert any(closure[st, fn] for fn in fa.final_states)
+
+
+def test_accepts_many_matches_accepts():
+    fa = AdjacencyMatrixFA(regex_to_dfa("(a | b)* a b"))
+    words = ["ab", "aab", "", "ba", "abab", "b", "aaab", "ab"]
+
+    assert fa.accepts_many(words) == [fa.accepts(word) for word in words]
+    assert fa.accepts_many(words) == [True, True, False, False, True, False, True, True]
+
+
+def test_is_empty_on_intersections():
+    a_star = AdjacencyMatrixFA(regex_to_dfa("a*"))
+    with_b = AdjacencyMatrixFA(regex_to_dfa("a* b"))
+    long_a = AdjacencyMatrixFA(regex_to_dfa("a a a a a a"))
+
+    assert intersect_automata(a_star, with_b).is_empty()
+    assert not intersect_automata(a_star, long_a).is_empty()
+
+
+def test_lazy_tensor_rpq_matches_materialized():
+    graph = cd.labeled_two_cycles_graph(5, 7, labels=("a", "b"))
+    start_nodes, final_nodes = {0, 3, 8}, set(graph.nodes)
+
+    for regex in ["a*", "a* b b", "(a | b)* b"]:
+        expected = tensor_based_rpq(regex, graph, start_nodes, final_nodes)
+        lazy = tensor_based_rpq(regex, graph, start_nodes, final_nodes, lazy=True)
+        assert lazy == expected
+
+
+def test_product_index_round_trip():
+    dfa1 = AdjacencyMatrixFA(regex_to_dfa("a b*"))
+    dfa2 = AdjacencyMatrixFA(regex_to_dfa("(a | b) c"))
+    intersect = intersect_automata(dfa1, dfa2)
+    index = intersect.index
+
+    idx = np.arange(intersect.states_count)
+    idx1, idx2 = index.decode(idx)
+    assert np.array_equal(index.encode(idx1, idx2), idx)
+
+    for pair, i in intersect.states.items():
+        assert intersect.idx_by_state[i] == pair
+
+
+def test_save_load_round_trip(tmp_path):
+    graph = cd.labeled_two_cycles_graph(4, 6, labels=("a", "b"))
+    graph_fa = AdjacencyMatrixFA(graph_to_nfa(graph, {0, 5}, {2}))
+    regex_fa = AdjacencyMatrixFA(regex_to_dfa("a* b"))
+    intersect = intersect_automata(regex_fa, graph_fa)
+
+    for fa in [graph_fa, regex_fa, intersect]:
+        fa.save(tmp_path / "fa")
+        loaded = AdjacencyMatrixFA.load(tmp_path / "fa")
+
+        # memory-mapped arrays are read-only views of the files
+        for matrix in loaded.matricies.values():
+            assert not matrix.indices.flags.writeable
+        assert loaded.alphabet == fa.alphabet
+        for state, i in fa.states.items():
+            j = loaded.states[state]
+            assert loaded.idx_by_state[j] == state
+            assert (i in fa.start_states) == (j in loaded.start_states)
+            assert (i in fa.final_states) == (j in loaded.final_states)
+        for symbol, matrix in fa.matricies.items():
+            assert (loaded.matricies[symbol] != matrix).nnz == 0
+
+    words = ["b", "ab", "aab", "ba", ""]
+    regex_fa.save(tmp_path / "fa")
+    loaded = AdjacencyMatrixFA.load(tmp_path / "fa", mmap=False, sparse_format="auto")
+    assert loaded.accepts_many(words) == regex_fa.accepts_many(words)
+
+
+def test_saved_size_grows_with_pairs(tmp_path):
+    graph = nx.MultiDiGraph()
+    graph.add_nodes_from(range(2000))
+    graph.add_edges_from((i, i + 1, {"label": f"l{i}"}) for i in range(200))
+    fa = AdjacencyMatrixFA(graph_to_nfa(graph, set(), set()))
+
+    fa.save(tmp_path / "fa")
+    # the state map and the start/final states take O(|V|) anyway
+    state_files = {"state", "start", "final"}
+    matrix_files = [
+        file
+        for file in tmp_path.glob("fa/*.npy")
+        if file.name.split("_")[0] not in state_files
+    ]
+    # a row pointer table per label would take 200 * 2001 * 4 bytes
+    assert sum(file.stat().st_size for file in matrix_files) < 10000
+    loaded = AdjacencyMatrixFA.load(tmp_path / "fa")
+    for symbol, matrix in fa.matricies.items():
+        assert (loaded.matricies[symbol] != matrix).nnz == 0
+        assert not loaded.matricies[symbol].indices.flags.writeable
+
+
+def test_save_writes_plain_data(tmp_path):
+    graph = nx.MultiDiGraph()
+    graph.add_edges_from(
+        [("x", ("p", 1), {"label": "a"}), (("p", 1), 3, {"label": ("b", 2)})]
+    )
+    fa = AdjacencyMatrixFA(graph_to_nfa(graph, {"x"}, {3}))
+
+    fa.save(tmp_path / "fa")
+    assert json.loads((tmp_path / "fa" / "meta.json").read_text())["states_count"] == 3
+    loaded = AdjacencyMatrixFA.load(tmp_path / "fa")
+    assert set(loaded.states) == set(fa.states)
+    assert loaded.alphabet == fa.alphabet == {Symbol("a"), Symbol(("b", 2))}
+
+    graph.add_edge(3, frozenset({1}), label="a")
+    with pytest.raises(ValueError):
+        AdjacencyMatrixFA(graph_to_nfa(graph, set(), set())).save(tmp_path / "bad")
+
+
+def test_update_matricies_patches_kept_closure():
+    fa = AdjacencyMatrixFA(regex_to_dfa("a b c"))
+    n = fa.states_count
+    fa.transitive_closure()
+
+    rng = np.random.default_rng(7)
+    for _ in range(3):
+        rows, columns = rng.integers(0, n, 2), rng.integers(0, n, 2)
+        delta = sp.csc_matrix((np.ones(2, dtype=bool), (rows, columns)), shape=(n, n))
+        before = fa.closure.toarray()
+        added = fa.update_matricies({Symbol("d"): delta})
+
+        expected = AdjacencyMatrixFA(sparse_format=sp.csc_matrix)
+        expected.states_count = n
+        expected.matricies = dict(fa.matricies)
+        full = expected.transitive_closure().toarray()
+        assert np.array_equal(fa.closure.toarray(), full)
+        assert np.array_equal(added.toarray(), full & ~before)
+
+
+def test_from_graph_matches_graph_to_nfa():
+    graph = cd.labeled_two_cycles_graph(4, 6, labels=("a", "b"))
+    graph.add_edge(3, 7, label="epsilon")
+    start_nodes, final_nodes = {0, 5, 42}, {2, 7}
+
+    direct = AdjacencyMatrixFA.from_graph(graph, start_nodes, final_nodes)
+    expected = graph_to_nfa(graph, start_nodes, final_nodes)
+
+    assert direct.to_nfa().is_equivalent_to(expected)
+    words = ["", "a", "b", "ab", "aaab", "bbbbb"]
+    assert direct.accepts_many(words) == AdjacencyMatrixFA(expected).accepts_many(words)
@@ -0,0 +1,208 @@
+import itertools
+import tracemalloc
+from collections import Counter
+import cfpq_data as cd
+import networkx as nx
+import numpy as np
+from project import task3, task4
+from project.graph_index import GraphIndex
+from project.query_cache import query_cache
+from project.task4 import (
+    BfsStats,
+    CellSet,
+    iter_ms_bfs_rpq,
+    ms_bfs_based_rpq,
+    ms_bfs_rpq_arrays,
+    plan_regex,
+)
+
+
+def test_push_and_pull_agree():
+    graph = cd.labeled_two_cycles_graph(6, 9, labels=("a", "b"))
+    start_nodes, final_nodes = {0, 2, 7}, set(graph.nodes)
+
+    for regex in ["a*", "a* b b", "(a | b)* b"]:
+        push, pull = BfsStats(), BfsStats()
+        expected = ms_bfs_based_rpq(regex, graph, start_nodes, final_nodes)
+        only_push = ms_bfs_based_rpq(
+            regex, graph, start_nodes, final_nodes, pull_ratio=float("inf"), stats=push
+        )
+        only_pull = ms_bfs_based_rpq(
+            regex, graph, start_nodes, final_nodes, pull_ratio=0, stats=pull
+        )
+
+        assert only_push == only_pull == expected
+        assert set(push.counts()) == {"push"} and set(pull.counts()) == {"pull"}
+        assert push.switches == pull.switches == 0
+
+
+def test_iter_yields_each_pair_once():
+    graph = cd.labeled_two_cycles_graph(40, 50, labels=("a", "b"))
+    start_nodes, final_nodes = {0, 3, 45}, set(graph.nodes)
+
+    pairs = list(iter_ms_bfs_rpq("a* b*", graph, start_nodes, final_nodes))
+    assert len(pairs) == len(set(pairs))
+    assert set(pairs) == ms_bfs_based_rpq("a* b*", graph, start_nodes, final_nodes)
+
+    # pairs close to the sources come first and the search stops with the caller
+    stats = BfsStats()
+    first = list(
+        itertools.islice(
+            iter_ms_bfs_rpq("a*", graph, start_nodes, final_nodes, stats=stats), 3
+        )
+    )
+    assert {start for start, _ in first} <= start_nodes
+    assert len(stats.directions) < 40
+
+
+def test_arrays_match_set():
+    graph = cd.labeled_two_cycles_graph(5, 8, labels=("a", "b"))
+    start_nodes, final_nodes = {0, 1, 6}, {0, 2, 3, 9, 13}
+
+    starts, finals = ms_bfs_rpq_arrays("a* b*", graph, start_nodes, final_nodes)
+    pairs = list(zip(starts.tolist(), finals.tolist()))
+    assert len(pairs) == len(set(pairs))
+    assert set(pairs) == ms_bfs_based_rpq("a* b*", graph, start_nodes, final_nodes)
+    assert set(starts.tolist()) <= start_nodes and set(finals.tolist()) <= final_nodes
+
+
+def test_nfa_mode_matches_dfa_mode():
+    graph = cd.labeled_two_cycles_graph(7, 5, labels=("a", "b"))
+    start_nodes, final_nodes = {0, 3, 9}, {0, 1, 2, 8}
+
+    for regex in ["a* b", "a b | b* a", "(a | b)* a (a | b) (a | b)", "a | $"]:
+        expected = ms_bfs_based_rpq(
+            regex, graph, start_nodes, final_nodes, regex_mode="dfa"
+        )
+        stats = BfsStats()
+        assert (
+            ms_bfs_based_rpq(
+                regex, graph, start_nodes, final_nodes, regex_mode="nfa", stats=stats
+            )
+            == expected
+        )
+        assert stats.plan.mode == "nfa"
+        assert (
+            set(
+                iter_ms_bfs_rpq(
+                    regex, graph, start_nodes, final_nodes, regex_mode="nfa"
+                )
+            )
+            == expected
+        )
+
+
+def test_plan_avoids_determinization_blowup():
+    assert plan_regex("a* b").mode == "dfa"
+
+    regex = "(a | b)* a" + " (a | b)" * 12
+    plan = plan_regex(regex)
+    assert plan.mode == "nfa" and plan.dfa_size is None
+
+    graph = cd.labeled_two_cycles_graph(20, 15, labels=("a", "b"))
+    stats = BfsStats()
+    answer = ms_bfs_based_rpq(regex, graph, {0, 5}, set(), stats=stats)
+    assert stats.plan == plan
+    assert answer == ms_bfs_based_rpq(regex, graph, {0, 5}, set(), regex_mode="nfa")
+
+
+def test_plan_compiles_each_automaton_once(monkeypatch):
+    calls = Counter()
+
+    def counted(module, name):
+        compile = getattr(module, name)
+
+        def wrapper(*args, **kwargs):
+            calls[name] += 1
+            return compile(*args, **kwargs)
+
+        monkeypatch.setattr(module, name, wrapper)
+
+    for module in [task3, task4]:
+        counted(module, "compile_regex")
+        counted(module, "compile_regex_nfa")
+
+    graph = cd.labeled_two_cycles_graph(5, 5, labels=("a", "b"))
+    query_cache.clear()
+    ms_bfs_based_rpq("a* b", graph, {0}, set())
+    ms_bfs_based_rpq("(a | b)* a" + " (a | b)" * 12, graph, {0}, set())
+    assert calls == {"compile_regex": 2, "compile_regex_nfa": 2}
+
+
+def test_push_levels_keep_visited_sparse():
+    n = 20000
+    graph = nx.MultiDiGraph()
+    graph.add_edges_from((i, i + 1, {"label": "a"}) for i in range(n - 1))
+    index = GraphIndex(graph)
+    start_nodes = set(range(0, n, 20))
+    ms_bfs_based_rpq("a", index, {0}, set())
+
+    stats = BfsStats()
+    tracemalloc.start()
+    try:
+        answer = ms_bfs_based_rpq(
+            "a a", index, start_nodes, set(), pull_ratio=float("inf"), stats=stats
+        )
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    assert answer == {(i, i + 2) for i in start_nodes}
+    assert set(stats.counts()) == {"push"}
+    # a dense visited bitmap alone would take len(start_nodes) * 3 * n bytes
+    assert peak < len(start_nodes) * 3 * n // 4
+
+
+def test_iter_memory_grows_with_discovered_pairs():
+    n = 20000
+    graph = nx.MultiDiGraph()
+    graph.add_edges_from((i, i + 1, {"label": "a"}) for i in range(n - 1))
+    index = GraphIndex(graph)
+    start_nodes = set(range(0, n, 20))
+    ms_bfs_based_rpq("a", index, {0}, set())
+
+    tracemalloc.start()
+    try:
+        pairs = iter_ms_bfs_rpq(
+            "a a", index, start_nodes, set(), pull_ratio=float("inf")
+        )
+        first = next(pairs)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    assert first[1] == first[0] + 2
+    # the reported pairs alone would take len(start_nodes) * n bytes as a bitmap
+    assert peak < len(start_nodes) * n // 4
+
+
+def test_cell_set_turns_into_bitmap():
+    cells = CellSet(100)
+    cells.add(np.array([3, 7], dtype=np.int64))
+    cells.add(np.array([1], dtype=np.int64))
+    assert cells.bitmap is None
+    assert cells.contains(np.array([1, 2, 3, 7])).tolist() == [True, False, True, True]
+
+    # thirteen int64 cells outweigh a bitmap of 100 cells
+    cells.add(np.arange(10, 20, dtype=np.int64))
+    assert cells.bitmap is not None and cells.runs == []
+    expected = [1, 3, 7, *range(10, 20)]
+    assert len(cells) == 13 and np.flatnonzero(cells.bitmap).tolist() == expected
+
+
+def test_node_ids_keep_their_types():
+    tuples = nx.MultiDiGraph()
+    tuples.add_edges_from(
+        [((0, 0), (0, 1), {"label": "a"}), ((0, 1), (1, 1), {"label": "b"})]
+    )
+    mixed = nx.MultiDiGraph()
+    mixed.add_edges_from([(1, "x", {"label": "a"}), ("x", 2, {"label": "b"})])
+
+    for graph, start, middle, final in [
+        (tuples, (0, 0), (0, 1), (1, 1)),
+        (mixed, 1, "x", 2),
+    ]:
+        expected = {(start, middle), (start, final)}
+        assert ms_bfs_based_rpq("a b*", graph, {start}, set()) == expected
+        starts, finals = ms_bfs_rpq_arrays("a b*", graph, {start}, set())
+        assert set(zip(starts.tolist(), finals.tolist())) == expected
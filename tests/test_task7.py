@@ -0,0 +1,34 @@
+import cfpq_data as cd
+import pytest
+import scipy.sparse as sp
+from pyformlang.cfg import CFG
+from project.bit_matrix import BitMatrix
+from project.dense_matrix import DenseMatrix
+from project.task6 import hellings_based_cfpq
+from project.task7 import matrix_based_cfpq
+
+FORMATS = [
+    sp.csr_matrix,
+    sp.csc_matrix,
+    sp.lil_matrix,
+    sp.dok_matrix,
+    BitMatrix,
+    DenseMatrix,
+    "auto",
+]
+
+
+@pytest.mark.parametrize("sparse_format", FORMATS)
+def test_formats_match_hellings(sparse_format):
+    graph = cd.labeled_two_cycles_graph(7, 5, labels=("a", "b"))
+    cfgs = [
+        CFG.from_text("S -> a S b | a b"),
+        CFG.from_text("S -> S S | a | b"),
+        CFG.from_text("S -> a S b S | $"),
+    ]
+
+    for cfg in cfgs:
+        for start_nodes, final_nodes in [(set(), set()), ({0, 3}, {1, 8, 12})]:
+            assert matrix_based_cfpq(
+                cfg, graph, start_nodes, final_nodes, sparse_format
+            ) == hellings_based_cfpq(cfg, graph, start_nodes, final_nodes)